@@ -0,0 +1,403 @@
+import argparse
+import collections
+import csv
+import gzip
+import json
+import os
+import re
+import shutil
+import socketserver
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import kerchunks
+
+NAMES = ["Kerchunk", "OPeNDAP", "OPeNDAP-compression"]
+# columns of results.csv, one file is written per chunk size
+FIELDS = ["name", "run", "data_node", "time", "bytes_recv", "bytes_sent", "packets_recv", "packets_sent",
+          "errin", "errout", "dropin", "dropout", "workers"]
+VARIABLE = "tas"
+
+# traffic seen by the stand-in servers, from the point of view of the client like psutil.net_io_counters
+counters = collections.Counter()
+lock = threading.Lock()
+
+
+def make_files(root, members, files, days, lat, lon):
+    """Daily tas files of each member, shaped, compressed and chunked like CMIP6 ones. Existing files are kept."""
+    import xarray
+
+    lats = np.linspace(-90, 90, lat)
+    lons = np.linspace(0, 360, lon, endpoint=False)
+    climatology = 273.15 + 30 * np.cos(np.deg2rad(lats))[:, None] * np.ones((lat, lon))
+    names = []
+    for m in range(members):
+        label = "r{}i1p1f2".format(m + 1)
+        names.append((label, []))
+        for f in range(files):
+            name = "tas_day_SYN-CM6-1_ssp245_{}_gr_{:03d}.nc".format(label, f)
+            names[-1][1].append(name)
+            path = os.path.join(root, name)
+            if os.path.exists(path):
+                continue
+
+            rng = np.random.default_rng(m * files + f)
+            t = np.arange(f * days, (f + 1) * days, dtype="f8")
+            seasonal = 10 * np.sin(2 * np.pi * t / 365.25)[:, None, None]
+            tas = (climatology + seasonal + rng.normal(0, 2, (days, lat, lon))).astype("f4")
+            ds = xarray.Dataset(
+                {VARIABLE: (("time", "lat", "lon"), tas, {"standard_name": "air_temperature", "units": "K"})},
+                coords={
+                    "time": ("time", t, {"units": "days since 2015-01-01", "calendar": "gregorian"}),
+                    "lat": ("lat", lats, {"units": "degrees_north"}),
+                    "lon": ("lon", lons, {"units": "degrees_east"}),
+                    "height": ((), 2.0, {"units": "m"})},
+                attrs={"variant_label": label, "tracking_id": "hdl:21.14100/synthetic-{}".format(name)})
+            encoding = {VARIABLE: {"zlib": True, "complevel": 1, "shuffle": True, "chunksizes": (1, lat, lon)}}
+            tmp = "{}.{}.tmp".format(path, os.getpid())
+            ds.to_netcdf(tmp, encoding=encoding, unlimited_dims=["time"])
+            os.replace(tmp, path)
+
+    return names
+
+
+class App:
+    """Data node stand-in: files over HTTP with range requests (fileServer) and, with pydap, OPeNDAP (dodsC)."""
+
+    def __init__(self, root, latency):
+        self.root = root
+        self.latency = latency
+        self.compress = False
+        self.handlers = {}
+        # the netCDF/HDF5 libraries are not thread safe
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        time.sleep(self.latency)
+        path = environ["PATH_INFO"]
+        try:
+            if path.startswith("/thredds/fileServer/"):
+                status, headers, body = self.file(environ, path[len("/thredds/fileServer/"):])
+            elif path.startswith("/thredds/dodsC/"):
+                status, headers, body = self.dods(environ, path[len("/thredds/dodsC/"):])
+            else:
+                status, headers, body = "404 Not Found", [], b""
+        except Exception as e:
+            print("Unable to serve {}: {}".format(path, e), file=sys.stderr, flush=True)
+            status, headers, body = "500 Internal Server Error", [], b""
+
+        # like HTTP compression in THREDDS, only OPeNDAP responses are compressed
+        if self.compress and path.startswith("/thredds/dodsC/") and "gzip" in environ.get("HTTP_ACCEPT_ENCODING", ""):
+            body = gzip.compress(body)
+            headers.append(("Content-Encoding", "gzip"))
+        if not any(k == "Content-Length" for k, _ in headers):
+            headers.append(("Content-Length", str(len(body))))
+        start_response(status, headers)
+
+        request = len("{} {}?{} HTTP/1.1\r\n\r\n".format(
+            environ["REQUEST_METHOD"], path, environ.get("QUERY_STRING", "")))
+        request += sum(len(k) - len("HTTP_") + len(v) + 4 for k, v in environ.items() if k.startswith("HTTP_"))
+        response = len("HTTP/1.1 {}\r\n\r\n".format(status)) + sum(len(k) + len(v) + 4 for k, v in headers)
+        with lock:
+            counters["bytes_sent"] += request + int(environ.get("CONTENT_LENGTH") or 0)
+            counters["bytes_recv"] += response + len(body)
+            counters["packets_sent"] += 1
+            counters["packets_recv"] += 1
+            counters["errin"] += int(status[:3]) >= 400
+
+        return [body]
+
+    def file(self, environ, name):
+        path = os.path.join(self.root, os.path.basename(name))
+        if not os.path.isfile(path):
+            return "404 Not Found", [], b""
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        status = "200 OK"
+        headers = [("Content-Type", "application/x-netcdf"), ("Accept-Ranges", "bytes")]
+        m = re.fullmatch(r"bytes=(\d+)-(\d*)", environ.get("HTTP_RANGE", ""))
+        if m is not None:
+            start, end = int(m.group(1)), min(int(m.group(2) or size - 1), size - 1)
+            status = "206 Partial Content"
+            headers.append(("Content-Range", "bytes {}-{}/{}".format(start, end, size)))
+        if environ["REQUEST_METHOD"] == "HEAD":
+            return status, headers + [("Content-Length", str(end - start + 1))], b""
+
+        with open(path, "rb") as f:
+            f.seek(start)
+            return status, headers, f.read(end - start + 1)
+
+    def dods(self, environ, name):
+        from pydap.handlers.lib import BaseHandler
+
+        base, _ = os.path.splitext(os.path.basename(name))
+        path = os.path.join(self.root, base)
+        if not os.path.isfile(path):
+            return "404 Not Found", [], b""
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = status
+            response["headers"] = [(k, v) for k, v in headers if k.lower() != "content-length"]
+
+        with self.lock:
+            if path not in self.handlers:
+                self.handlers[path] = BaseHandler(dap_dataset(path))
+            body = b"".join(self.handlers[path](environ, start_response))
+
+        return response["status"], response["headers"], body
+
+
+class Variable:
+    """Variable of a file read on demand, the data of a pydap BaseType."""
+
+    def __init__(self, path, name, shape, dtype):
+        self.path = path
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+        self.ndim = len(shape)
+        self.size = int(np.prod(shape))
+
+    def __getitem__(self, key):
+        import h5netcdf
+
+        with h5netcdf.File(self.path, "r") as f:
+            return np.asarray(f.variables[self.name][... if key is None else key])
+
+
+def dap_dataset(path):
+    """pydap dataset of a file, read with h5netcdf so that the netCDF library of the client is not shared."""
+    import h5netcdf
+    from pydap.model import BaseType, DatasetType
+
+    with h5netcdf.File(path, "r") as f:
+        dataset = DatasetType(os.path.basename(path), attributes=dict(f.attrs))
+        for name, v in f.variables.items():
+            # coordinates are small, only arrays with more dimensions are read on demand
+            data = Variable(path, name, v.shape, v.dtype) if v.ndim > 1 else np.asarray(v[...])
+            dataset[name] = BaseType(name, data=data, dims=v.dimensions, attributes=dict(v.attrs))
+
+    return dataset
+
+
+class Server(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class Handler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve(root, latency):
+    server = Server(("127.0.0.1", 0), Handler)
+    server.set_app(App(root, latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "127.0.0.1:{}".format(server.server_address[1])
+
+
+def make_refs(host, members, cache):
+    """Kerchunk references of the ensemble served by host, generated like kerchunks.py does."""
+    if os.path.exists(cache):
+        os.remove(cache)
+    conn = sqlite3.connect(cache)
+    kerchunks.createcache(conn)
+    tasks = []
+    for label, names in members:
+        urls = [kerchunks.get_url("http://{}/thredds/dodsC/{}".format(host, name)) for name in names]
+        for url in urls:
+            url, refs = kerchunks.scan_file(url)
+            conn.execute("INSERT INTO refs VALUES (?, ?)", (url, zlib.compress(json.dumps(refs).encode())))
+        tasks.append((label, urls, False))
+    conn.commit()
+    conn.close()
+
+    kerchunks.init_worker(cache)
+    return kerchunks.combine_members(VARIABLE, tasks)
+
+
+def open_kerchunk(refs):
+    import xarray
+
+    return xarray.open_dataset(
+        "reference://",
+        engine="zarr",
+        backend_kwargs={
+            "consolidated": False,
+            "storage_options": {
+                "fo": refs,
+                "remote_protocol": "http",
+                "remote_options": {"asynchronous": True},
+                "asynchronous": True}})
+
+
+def open_opendap(host, members):
+    import xarray
+
+    # a single file server has no NcML aggregations, files are joined by the client like the esgf_ensemble NcMLs do
+    urls = [["http://{}/thredds/dodsC/{}".format(host, name) for name in names] for _, names in members]
+    ds = xarray.open_mfdataset(
+        urls,
+        engine="netcdf4",
+        combine="nested",
+        concat_dim=["variant_label", "time"],
+        data_vars="all",
+        coords="minimal",
+        compat="override")
+    return ds.assign_coords(variant_label=[label for label, _ in members])
+
+
+def measure(op, name, nworkers, run, data_node):
+    with lock:
+        start_net = dict(counters)
+    start_time = time.time()
+
+    op.compute(scheduler="processes", num_workers=nworkers)
+
+    end_time = time.time()
+    with lock:
+        end_net = dict(counters)
+
+    result = {"name": name, "run": run, "data_node": data_node, "time": end_time - start_time}
+    for field in FIELDS[4:12]:
+        result[field] = end_net.get(field, 0) - start_net.get(field, 0)
+    result["workers"] = nworkers
+
+    return result
+
+
+def output_path(path, chunk, chunks):
+    """Results file of a chunk size, path itself if there is a single chunk size."""
+    if len(chunks) == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return "{}-c{}{}".format(root, chunk, ext)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time and traffic of Kerchunk and OPeNDAP access to an ensemble served by local data nodes.")
+    parser.add_argument("-n", "--name",
+                        choices=NAMES,
+                        nargs="+",
+                        type=str,
+                        required=False,
+                        default=NAMES,
+                        help="access methods, OPeNDAP requires pydap, h5netcdf and netCDF4.")
+    parser.add_argument("-w", "--workers",
+                        nargs="+",
+                        type=int,
+                        required=False,
+                        default=[2, 4, 8],
+                        help="numbers of dask workers.")
+    parser.add_argument("-c", "--chunks",
+                        nargs="+",
+                        type=int,
+                        required=False,
+                        default=[400],
+                        help="time steps per dask chunk, results of each one are written to their own file.")
+    parser.add_argument("-r", "--runs",
+                        type=int,
+                        required=False,
+                        default=3,
+                        help="number of runs.")
+    parser.add_argument("--latency",
+                        nargs="+",
+                        type=float,
+                        required=False,
+                        default=[0],
+                        help="seconds added to each request, one data node per value.")
+    parser.add_argument("--members",
+                        type=int,
+                        required=False,
+                        default=3,
+                        help="number of members of the ensemble.")
+    parser.add_argument("--files",
+                        type=int,
+                        required=False,
+                        default=2,
+                        help="files per member.")
+    parser.add_argument("--days",
+                        type=int,
+                        required=False,
+                        default=365,
+                        help="time steps per file.")
+    parser.add_argument("--grid",
+                        nargs=2,
+                        type=int,
+                        required=False,
+                        default=[64, 128],
+                        help="number of latitudes and longitudes.")
+    parser.add_argument("-d", "--dir",
+                        type=str,
+                        required=False,
+                        default=None,
+                        help="directory of the synthetic files, kept between runs. A temporary one by default.")
+    parser.add_argument("-o", "--output",
+                        type=str,
+                        required=False,
+                        default=None,
+                        help="results file, standard output by default. With several chunk sizes, the chunk size "
+                             "is added to its name (eg: results-c400.csv).")
+    args = vars(parser.parse_args())
+    if len(args["chunks"]) > 1 and args["output"] is None:
+        parser.error("several --chunks need -o/--output, results are written to a file per chunk size.")
+
+    names = args["name"]
+    if any(name.startswith("OPeNDAP") for name in names):
+        try:
+            import h5netcdf
+            import netCDF4
+            import pydap.handlers.lib
+        except ImportError as e:
+            print("Skipping OPeNDAP: {}".format(e), file=sys.stderr, flush=True)
+            names = [name for name in names if not name.startswith("OPeNDAP")]
+
+    directory = args["dir"] or tempfile.mkdtemp(prefix="eva-access-")
+    os.makedirs(directory, exist_ok=True)
+    members = make_files(directory, args["members"], args["files"], args["days"], *args["grid"])
+    nodes = [("dn{}".format(i), *serve(directory, latency)) for i, latency in enumerate(args["latency"])]
+
+    outs = {}
+    writers = {}
+    for chunk in args["chunks"]:
+        if args["output"] is not None:
+            outs[chunk] = open(output_path(args["output"], chunk, args["chunks"]), "w", newline="")
+        else:
+            outs[chunk] = sys.stdout
+        writers[chunk] = csv.DictWriter(outs[chunk], fieldnames=FIELDS)
+        writers[chunk].writeheader()
+    for name in names:
+        for dn, server, host in nodes:
+            if name == "Kerchunk":
+                ds = open_kerchunk(make_refs(host, members, os.path.join(directory, "kerchunks.db")))
+            else:
+                # recent netCDF libraries always accept compressed responses, HTTP.DEFLATE in ~/.dodsrc is gone
+                server.get_app().compress = name == "OPeNDAP-compression"
+                ds = open_opendap(host, members)
+            for n in args["workers"]:
+                for chunk in args["chunks"]:
+                    for r in range(args["runs"]):
+                        v = ds[VARIABLE].chunk({"variant_label": 1, "time": chunk})
+                        writers[chunk].writerow(measure(v.mean(["lat", "lon"]), name, n, r, dn))
+                        outs[chunk].flush()
+            ds.close()
+
+    for _, server, _ in nodes:
+        server.shutdown()
+        server.server_close()
+    for out in outs.values():
+        if out is not sys.stdout:
+            out.close()
+    if args["dir"] is None:
+        shutil.rmtree(directory)
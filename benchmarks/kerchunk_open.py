@@ -0,0 +1,101 @@
+import argparse
+import contextlib
+import csv
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+import fsspec
+import zarr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import kerchunks
+
+
+def open_refs(fo, remote_protocol):
+    """Zarr group of the references, the JSON is loaded whole while parquet is loaded lazily."""
+    fs = fsspec.filesystem(
+        "reference",
+        fo=fo,
+        remote_protocol=remote_protocol,
+        remote_options={"asynchronous": True},
+        asynchronous=True,
+        skip_instance_cache=True)
+    return zarr.open_group(zarr.storage.FsspecStore(fs, read_only=True), mode="r", use_consolidated=False)
+
+
+def measure(fmt, path, remote_protocol, variable):
+    tracemalloc.start()
+    start = time.perf_counter()
+    group = open_refs(kerchunks.load(path) if fmt == "json" else path, remote_protocol)
+    shapes = {k: a.shape for k, a in group.arrays()}
+    open_time = time.perf_counter() - start
+    read_time = None
+    if variable is not None:
+        start = time.perf_counter()
+        group[variable][(0,) * len(shapes[variable])]
+        read_time = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return open_time, read_time, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time and memory to open kerchunk references stored as zipped JSON and as parquet.")
+    parser.add_argument("refs",
+                        nargs="+",
+                        type=str,
+                        help=".json.zip files written by kerchunks.py.")
+    parser.add_argument("-d", "--dest",
+                        type=str,
+                        required=False,
+                        default="kerchunks_parquet",
+                        help="directory of the parquet conversions.")
+    parser.add_argument("--remote-protocol",
+                        type=str,
+                        required=False,
+                        default="https",
+                        help="protocol of the referenced files.")
+    parser.add_argument("--read",
+                        type=str,
+                        required=False,
+                        default=None,
+                        help="also read the first chunk of this variable, requires access to the files.")
+    parser.add_argument("--measure",
+                        nargs=2,
+                        type=str,
+                        required=False,
+                        default=None,
+                        help=argparse.SUPPRESS)
+    args = vars(parser.parse_args())
+
+    # each measurement runs in a new interpreter so that nothing is cached between them
+    if args["measure"] is not None:
+        print(*measure(*args["measure"], args["remote_protocol"], args["read"]))
+        sys.exit(0)
+
+    os.makedirs(args["dest"], exist_ok=True)
+    out = csv.writer(sys.stdout)
+    out.writerow(["aggregation", "format", "size", "open_time", "read_time", "peak_memory"])
+    for f in args["refs"]:
+        key = os.path.basename(f)[:-len(kerchunks.EXTENSIONS["json"])]
+        parquet = os.path.join(args["dest"], key + kerchunks.EXTENSIONS["parquet"])
+        if not os.path.exists(parquet):
+            with contextlib.redirect_stdout(sys.stderr):
+                kerchunks.save_parquet(args["dest"], key, kerchunks.load(f))
+
+        for fmt, fo in [("json", f), ("parquet", parquet)]:
+            size = os.path.getsize(fo) if os.path.isfile(fo) else sum(
+                os.path.getsize(os.path.join(d, n)) for d, _, names in os.walk(fo) for n in names)
+            cmd = [sys.executable, __file__, f, "--measure", fmt, fo, "--remote-protocol", args["remote_protocol"]]
+            if args["read"] is not None:
+                cmd += ["--read", args["read"]]
+            p = subprocess.run(cmd, stdout=subprocess.PIPE, text=True)
+            if p.returncode != 0:
+                print("Unable to open {}.".format(fo), file=sys.stderr, flush=True)
+                continue
+            out.writerow([key, fmt, size] + p.stdout.split())
+            sys.stdout.flush()
@@ -0,0 +1,400 @@
+import argparse
+import collections
+import datetime
+import gzip
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+
+EXPERIMENTS = [("CMIP", "historical"), ("ScenarioMIP", "ssp126"), ("ScenarioMIP", "ssp245"),
+               ("ScenarioMIP", "ssp370"), ("ScenarioMIP", "ssp585"), ("CMIP", "piControl"), ("CMIP", "amip")]
+VARIABLES = [("day", "tas", "day", "atmos"), ("Amon", "tas", "mon", "atmos"), ("Amon", "pr", "mon", "atmos"),
+             ("day", "pr", "day", "atmos"), ("Omon", "tos", "mon", "ocean"), ("Amon", "ua", "mon", "atmos")]
+T0 = datetime.datetime(2020, 1, 1)  # _timestamp of the first record, one millisecond per record after it
+CACHE = 8  # filtered result sets kept by each index node
+# a fragment of the document per field, like Solr returns them
+FIELDS = collections.OrderedDict([
+    ("id", '"id":"{instance_id}|{data_node}"'),
+    ("version", '"version":"1"'),
+    ("checksum", '"checksum":["{checksum}"]'),
+    ("checksum_type", '"checksum_type":["SHA256"]'),
+    ("data_node", '"data_node":"{data_node}"'),
+    ("index_node", '"index_node":"{index_node}"'),
+    ("instance_id", '"instance_id":"{instance_id}"'),
+    ("master_id", '"master_id":"{master_id}"'),
+    ("replica", '"replica":{replica}'),
+    ("size", '"size":{size}'),
+    ("timestamp", '"timestamp":"{timestamp}"'),
+    ("title", '"title":"{title}"'),
+    ("tracking_id", '"tracking_id":["hdl:21.14100/{tracking_id}"]'),
+    ("_timestamp", '"_timestamp":"{_timestamp}"'),
+    ("mip_era", '"mip_era":["CMIP6"]'),
+    ("project", '"project":["CMIP6"]'),
+    ("institution_id", '"institution_id":["{institution_id}"]'),
+    ("source_id", '"source_id":["{source_id}"]'),
+    ("experiment_id", '"experiment_id":["{experiment_id}"]'),
+    ("table_id", '"table_id":["{table_id}"]'),
+    ("variable_id", '"variable_id":["{variable_id}"]'),
+    ("grid_label", '"grid_label":["gn"]'),
+    ("frequency", '"frequency":["{frequency}"]'),
+    ("realm", '"realm":["{realm}"]'),
+    ("product", '"product":["model-output"]'),
+    ("variant_label", '"variant_label":["{variant_label}"]'),
+    ("further_info_url", '"further_info_url":["https://furtherinfo.es-doc.org/{dataset}"]'),
+    ("activity_id", '"activity_id":["{activity_id}"]'),
+    ("pid", '"pid":["hdl:21.14100/{pid}"]'),
+    ("member_id", '"member_id":["{member_id}"]'),
+    ("sub_experiment_id", '"sub_experiment_id":["{sub_experiment_id}"]'),
+    ("dataset_id", '"dataset_id":"{dataset}.{version}|{data_node}"'),
+    ("latest", '"latest":{latest}'),
+    ("retracted", '"retracted":{retracted}'),
+    ("url", '"url":["http://{data_node}/thredds/fileServer/{path}|application/netcdf|HTTPServer",'
+            '"http://{data_node}/thredds/dodsC/{path}.html|application/opendap-html|OPENDAP"]'),
+    # returned by index nodes but not used by search.py, only sent when fields are not given
+    ("type", '"type":"File"'),
+    ("activity_drs", '"activity_drs":["{activity_id}"]'),
+    ("variable", '"variable":["{variable_id}"]'),
+    ("cf_standard_name", '"cf_standard_name":["synthetic_{variable_id}"]'),
+    ("variable_long_name", '"variable_long_name":["Synthetic {variable_id} of {source_id}"]'),
+    ("variable_units", '"variable_units":["1"]'),
+    ("nominal_resolution", '"nominal_resolution":["100 km"]'),
+    ("source_type", '"source_type":["AOGCM","BGC","AER"]'),
+    ("experiment_title", '"experiment_title":["{experiment_id} ({activity_id})"]'),
+    ("data_specs_version", '"data_specs_version":["01.00.29"]'),
+    ("model_cohort", '"model_cohort":["Registered"]'),
+    ("citation_url", '"citation_url":["http://cera-www.dkrz.de/WDCC/meta/CMIP6/{dataset}.v1.json"]'),
+    ("dataset_id_template_", '"dataset_id_template_":["%(mip_era)s.%(activity_drs)s.%(institution_id)s.'
+                             '%(source_id)s.%(experiment_id)s.%(member_id)s.%(table_id)s.%(variable_id)s.'
+                             '%(grid_label)s"]'),
+    ("directory_format_template_", '"directory_format_template_":["%(root)s/%(mip_era)s/%(activity_drs)s/'
+                                   '%(institution_id)s/%(source_id)s/%(experiment_id)s/%(member_id)s/%(table_id)s/'
+                                   '%(variable_id)s/%(grid_label)s/%(version)s"]'),
+    ("short_description", '"short_description":["{experiment_id} {member_id} {table_id} {variable_id}"]'),
+    ("score", '"score":1.0'),
+])
+DOC = "{{" + ",".join(FIELDS.values()) + "}}"
+
+
+class Corpus:
+    """Synthetic CMIP6 file records, computed from their position so that any scale fits in memory.
+
+    Record i is a digit in each dimension (source, experiment, variable, member,
+    version, copy, file). Copies of a dataset are held by consecutive data nodes,
+    the first one is the master and the others replicas. Only the last version
+    is latest, and the older versions of some sources are retracted.
+    """
+
+    def __init__(self, sources=20, experiments=5, sub_experiments=3, variables=4, members=5, versions=2,
+                 data_nodes=4, replicas=2, files=10):
+        self.experiments = [(a, e, "none") for a, e in EXPERIMENTS[:experiments]]
+        self.experiments += [("DCPP", "dcppA-hindcast", "s{}".format(1960 + k)) for k in range(sub_experiments)]
+        self.variables = VARIABLES[:variables]
+        self.data_nodes = ["esgf-data{}.example.org".format(k) for k in range(data_nodes)]
+        self.dims = collections.OrderedDict([
+            ("source", sources), ("experiment", len(self.experiments)), ("variable", len(self.variables)),
+            ("member", members), ("version", versions), ("copy", min(replicas, data_nodes)), ("file", files)])
+        self.strides = {}
+        stride = 1
+        for dim in reversed(self.dims):
+            self.strides[dim] = stride
+            stride *= self.dims[dim]
+        self.size = stride
+
+        # facets as codes computed from the digits, and the value of each code
+        e, m = len(self.experiments), members
+        self.facets = {
+            "data_node": (lambda d: (d["source"] + d["copy"]) % data_nodes, self.data_nodes),
+            "source_id": (lambda d: d["source"], [self.source(s) for s in range(sources)]),
+            "institution_id": (lambda d: d["source"], [self.institution(s) for s in range(sources)]),
+            "experiment_id": (lambda d: d["experiment"], [x[1] for x in self.experiments]),
+            "activity_id": (lambda d: d["experiment"], [x[0] for x in self.experiments]),
+            "sub_experiment_id": (lambda d: d["experiment"], [x[2] for x in self.experiments]),
+            "variable_id": (lambda d: d["variable"], [x[1] for x in self.variables]),
+            "table_id": (lambda d: d["variable"], [x[0] for x in self.variables]),
+            "frequency": (lambda d: d["variable"], [x[2] for x in self.variables]),
+            "variant_label": (lambda d: d["member"], [self.variant_label(k) for k in range(m)]),
+            "member_id": (lambda d: d["experiment"] * m + d["member"],
+                          [self.member_id(x, k) for x in range(e) for k in range(m)]),
+            "latest": (lambda d: (d["version"] == versions - 1).astype(int), ["false", "true"]),
+            "retracted": (lambda d: self.retracted(d["source"], d["version"], versions).astype(int),
+                          ["false", "true"]),
+        }
+
+    def source(self, s):
+        return "SYN-CM{}".format(s)
+
+    def institution(self, s):
+        return "SYN-INST{}".format(s // 3)
+
+    def variant_label(self, k):
+        return "r{}i1p1f1".format(k + 1)
+
+    def member_id(self, e, k):
+        sub = self.experiments[e][2]
+        return self.variant_label(k) if sub == "none" else "{}-{}".format(sub, self.variant_label(k))
+
+    def retracted(self, source, version, versions):
+        return (version < versions - 1) & (source % 10 == 3)
+
+    def digits(self, idx):
+        return {dim: (idx // self.strides[dim]) % size for dim, size in self.dims.items()}
+
+    def select(self, filters, frm=None, to=None):
+        """Positions of the records matching the facet filters and the _timestamp range, in order."""
+        idx = np.arange(self.size, dtype=np.int64)
+        for facet, value in filters.items():
+            code, values = self.facets[facet]
+            codes = [c for c, v in enumerate(values) if v == value]
+            idx = idx[np.isin(code(self.digits(idx)), codes)]
+        if frm is not None:
+            idx = idx[np.searchsorted(idx, position(frm)):]
+        if to is not None:
+            idx = idx[:np.searchsorted(idx, position(to), side="right")]
+
+        return idx
+
+    def counts(self, idx, facet):
+        code, values = self.facets[facet]
+        counts = collections.Counter()
+        for c, n in enumerate(np.bincount(code(self.digits(idx)), minlength=len(values))):
+            if n:
+                counts[values[c]] += int(n)
+
+        return [x for value, n in sorted(counts.items()) for x in (value, n)]
+
+    def doc(self, i, index_node, template=DOC):
+        d = {dim: int(v) for dim, v in self.digits(np.int64(i)).items()}
+        activity, experiment, sub = self.experiments[d["experiment"]]
+        table, variable, frequency, realm = self.variables[d["variable"]]
+        source = self.source(d["source"])
+        institution = self.institution(d["source"])
+        member = self.member_id(d["experiment"], d["member"])
+        version = "v{}0101".format(2019 + d["version"])
+        dataset = "CMIP6.{}.{}.{}.{}.{}.{}.{}.gn".format(
+            activity, institution, source, experiment, member, table, variable)
+        title = "{}_{}_{}_{}_{}_gn_{}01-{}12.nc".format(
+            variable, table, source, experiment, member, 2015 + 10 * d["file"], 2024 + 10 * d["file"])
+        # copies of a file share everything but the data node
+        f = i - d["copy"] * self.strides["copy"]
+        return template.format(
+            instance_id="{}.{}.{}".format(dataset, version, title),
+            data_node=self.data_nodes[(d["source"] + d["copy"]) % len(self.data_nodes)],
+            index_node=index_node,
+            checksum="{:064x}".format(f),
+            master_id="{}.{}".format(dataset, title),
+            replica="true" if d["copy"] else "false",
+            size=1000000 + f % 1000000,
+            timestamp="{}-01-01T00:00:00Z".format(2019 + d["version"]),
+            title=title,
+            tracking_id="{:08x}-0000-0000-0000-{:012x}".format(d["source"], f),
+            _timestamp=timestamp(i),
+            institution_id=institution,
+            source_id=source,
+            experiment_id=experiment,
+            table_id=table,
+            variable_id=variable,
+            frequency=frequency,
+            realm=realm,
+            variant_label=self.variant_label(d["member"]),
+            dataset=dataset,
+            activity_id=activity,
+            pid="{:012x}".format(f),
+            member_id=member,
+            sub_experiment_id=sub,
+            version=version,
+            latest="true" if d["version"] == self.dims["version"] - 1 else "false",
+            retracted="true" if self.retracted(d["source"], d["version"], self.dims["version"]) else "false",
+            path="{}/{}/{}".format(dataset.replace(".", "/"), version, title))
+
+
+def timestamp(i):
+    t = T0 + datetime.timedelta(milliseconds=int(i))
+    return t.strftime("%Y-%m-%dT%H:%M:%S.") + "{:03d}Z".format(t.microsecond // 1000)
+
+
+def position(ts):
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"):
+        try:
+            t = datetime.datetime.strptime(ts, fmt)
+            break
+        except ValueError:
+            pass
+    else:
+        raise ValueError("Unknown timestamp format: {}".format(ts))
+
+    return int((t - T0) / datetime.timedelta(milliseconds=1))
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/esg-search/search":
+            self.reply(404, b"")
+            return
+
+        q = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        time.sleep(self.server.latency)
+        limit = int(q.get("limit", 10))
+        # only pages fail, like overloaded index nodes timing out on large responses
+        if limit > 0 and self.server.random.random() < self.server.failures:
+            self.reply(503, b"")
+            return
+
+        corpus = self.server.corpus
+        filters = {k: v for k, v in q.items() if k in corpus.facets}
+        idx = self.server.select(filters, q.get("from"), q.get("to"))
+        offset = int(q.get("offset", 0))
+        template = DOC
+        if "fields" in q:
+            template = "{{" + ",".join([FIELDS[f] for f in q["fields"].split(",") if f in FIELDS]) + "}}"
+        docs = ",".join([corpus.doc(i, self.server.name, template) for i in idx[offset:offset + limit]])
+        facets = ""
+        if "facets" in q:
+            facets = ',"facet_counts":{{"facet_fields":{}}}'.format(json.dumps(
+                {f: corpus.counts(idx, f) for f in q["facets"].split(",") if f in corpus.facets}))
+        body = '{{"responseHeader":{{"status":0}},"response":{{"numFound":{},"start":{},"docs":[{}]}}{}}}'.format(
+            len(idx), offset, docs, facets).encode()
+        self.reply(200, body)
+
+    def reply(self, status, body):
+        self.send_response(status)
+        if self.server.compress and "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, 1)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Server(ThreadingHTTPServer):
+    """Mock esg-search endpoint over a Corpus, with optional latency and failures."""
+
+    daemon_threads = True
+
+    def __init__(self, address, corpus, latency=0, failures=0, compress=False, seed=0):
+        super().__init__(address, Handler)
+        self.corpus = corpus
+        self.latency = latency
+        self.failures = failures
+        self.compress = compress
+        self.random = random.Random(seed)
+        self.name = "{}:{}".format(*self.server_address[:2])
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def select(self, filters, frm, to):
+        key = json.dumps([filters, frm, to], sort_keys=True)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        idx = self.corpus.select(filters, frm, to)
+        with self.lock:
+            self.cache[key] = idx
+            while len(self.cache) > CACHE:
+                self.cache.popitem(last=False)
+
+        return idx
+
+
+def add_arguments(parser):
+    """Options of the synthetic corpus, shared with the benchmarks that start a mock index."""
+    parser.add_argument("--sources",
+                        type=int,
+                        required=False,
+                        default=20,
+                        help="number of source_id.")
+    parser.add_argument("--experiments",
+                        type=int,
+                        required=False,
+                        default=5,
+                        help="number of experiments without sub_experiment_id (at most {}).".format(len(EXPERIMENTS)))
+    parser.add_argument("--sub-experiments",
+                        type=int,
+                        required=False,
+                        default=3,
+                        help="number of sub_experiment_id of dcppA-hindcast.")
+    parser.add_argument("--variables",
+                        type=int,
+                        required=False,
+                        default=4,
+                        help="number of variables (at most {}).".format(len(VARIABLES)))
+    parser.add_argument("--members",
+                        type=int,
+                        required=False,
+                        default=5,
+                        help="members of each ensemble.")
+    parser.add_argument("--versions",
+                        type=int,
+                        required=False,
+                        default=2,
+                        help="versions of each dataset, only the last one is latest.")
+    parser.add_argument("--data-nodes",
+                        type=int,
+                        required=False,
+                        default=4,
+                        help="number of data nodes.")
+    parser.add_argument("--replicas",
+                        type=int,
+                        required=False,
+                        default=2,
+                        help="copies of each dataset, including the master.")
+    parser.add_argument("--files",
+                        type=int,
+                        required=False,
+                        default=10,
+                        help="files per dataset.")
+
+
+def get_corpus(args):
+    return Corpus(args["sources"], args["experiments"], args["sub_experiments"], args["variables"], args["members"],
+                  args["versions"], args["data_nodes"], args["replicas"], args["files"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock ESGF index node serving synthetic CMIP6 file records.")
+    parser.add_argument("--host",
+                        type=str,
+                        required=False,
+                        default="127.0.0.1",
+                        help="address to listen on.")
+    parser.add_argument("--port",
+                        type=int,
+                        required=False,
+                        default=8090,
+                        help="port to listen on.")
+    parser.add_argument("--latency",
+                        type=float,
+                        required=False,
+                        default=0,
+                        help="seconds added to each request.")
+    parser.add_argument("--failures",
+                        type=float,
+                        required=False,
+                        default=0,
+                        help="fraction of page requests answered with 503.")
+    parser.add_argument("--compress",
+                        action="store_true",
+                        default=False,
+                        help="gzip responses when the client accepts it.")
+    add_arguments(parser)
+    args = vars(parser.parse_args())
+
+    corpus = get_corpus(args)
+    server = Server((args["host"], args["port"]), corpus, args["latency"], args["failures"], args["compress"])
+    print("Serving {} records at http://{}/esg-search/search".format(corpus.size, server.name), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -0,0 +1,82 @@
+import argparse
+import csv
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+MODES = ("scan", "query")
+
+
+def run(directory, mode, database, projects, jobs):
+    """Time of ncmls.py in a mode, and the NcMLs written, by path relative to the working directory."""
+    cwd = os.path.join(directory, mode)
+    shutil.rmtree(cwd, ignore_errors=True)
+    os.makedirs(cwd)
+
+    cmd = [sys.executable, os.path.join(ROOT, "ncmls.py"), "--database", os.path.abspath(database),
+           "-m", mode, "-j", str(jobs), "-p"] + projects
+    start = time.perf_counter()
+    subprocess.run(cmd, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    elapsed = time.perf_counter() - start
+
+    files = {}
+    for path, _, names in os.walk(os.path.join(cwd, "content")):
+        for name in names:
+            with open(os.path.join(path, name), "rb") as f:
+                files[os.path.relpath(os.path.join(path, name), cwd)] = f.read()
+
+    return elapsed, files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time ncmls.py in scan and query mode, and check that both write the same NcMLs.")
+    parser.add_argument("--database",
+                        required=True,
+                        type=str,
+                        help="database file.")
+    parser.add_argument("-p", "--project",
+                        nargs="+",
+                        type=str,
+                        required=False,
+                        default=["esgf_dataset", "esgf_ensemble"],
+                        help="types of ESGF Virtual Aggregation.")
+    parser.add_argument("-j", "--jobs",
+                        type=int,
+                        required=False,
+                        default=4,
+                        help="number of jobs.")
+    parser.add_argument("-d", "--dir",
+                        type=str,
+                        required=False,
+                        default=None,
+                        help="working directory, a temporary one by default.")
+    args = vars(parser.parse_args())
+
+    directory = args["dir"] or tempfile.mkdtemp(prefix="eva-modes-")
+    os.makedirs(directory, exist_ok=True)
+    try:
+        results = {mode: run(directory, mode, args["database"], args["project"], args["jobs"]) for mode in MODES}
+    finally:
+        if args["dir"] is None:
+            shutil.rmtree(directory)
+
+    scanned, queried = results["scan"][1], results["query"][1]
+    differ = sorted(set(scanned) ^ set(queried)) + sorted(
+        [path for path in set(scanned) & set(queried) if scanned[path] != queried[path]])
+
+    out = csv.writer(sys.stdout)
+    out.writerow(["mode", "time", "files", "identical"])
+    for mode in MODES:
+        out.writerow([mode, results[mode][0], len(results[mode][1]), not differ])
+    sys.stdout.flush()
+
+    for path in differ[:10]:
+        print("Differs: {}".format(path), file=sys.stderr, flush=True)
+    if differ:
+        print("{} NcMLs differ between scan and query mode.".format(len(differ)), file=sys.stderr, flush=True)
+        sys.exit(1)
@@ -0,0 +1,168 @@
+import argparse
+import csv
+import multiprocessing
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mock_index
+
+FIELDS = ["stage", "jobs", "time", "items", "rate", "db_size", "errors"]
+
+
+def start_index(corpus, latency, failures, compress, seed):
+    """Mock index node in its own process, so that it does not compete with the harvest for the GIL."""
+    server = mock_index.Server(("127.0.0.1", 0), corpus, latency, failures, compress, seed)
+    p = multiprocessing.get_context("fork").Process(target=server.serve_forever, daemon=True)
+    p.start()
+    server.socket.close()
+    return p, "http://{}".format(server.name)
+
+
+def db_size(path):
+    return sum([os.path.getsize(f) for f in (path, path + "-wal") if os.path.exists(f)])
+
+
+def run_search(directory, jobs, nodes, pages, normalized):
+    dest = os.path.join(directory, "search-j{}.db".format(jobs))
+    log = os.path.join(directory, "search-j{}.log".format(jobs))
+    for f in (dest, dest + "-wal", dest + "-shm", log):
+        if os.path.exists(f):
+            os.remove(f)
+
+    cmd = [sys.executable, os.path.join(ROOT, "search.py"), "-d", dest, "-l", log, "-j", str(jobs),
+           "--pages", str(pages), "--index-node"] + nodes
+    if normalized:
+        cmd.append("-n")
+    start = time.perf_counter()
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+    elapsed = time.perf_counter() - start
+
+    conn = sqlite3.connect(dest)
+    rows = conn.execute("SELECT count(*) FROM cmip6").fetchone()[0]
+    conn.close()
+    with open(log) as f:
+        errors = len(re.findall("Failed while retrieving", f.read()))
+
+    return dest, {"stage": "search", "jobs": jobs, "time": elapsed, "items": rows, "rate": rows / elapsed,
+                  "db_size": db_size(dest), "errors": errors}
+
+
+def run_ncmls(directory, jobs, database, projects, store):
+    cwd = os.path.join(directory, "ncmls-j{}".format(jobs))
+    shutil.rmtree(cwd, ignore_errors=True)
+    os.makedirs(cwd)
+
+    cmd = [sys.executable, os.path.join(ROOT, "ncmls.py"), "--database", os.path.abspath(database),
+           "-j", str(jobs), "-f", "-p"] + projects
+    if store:
+        cmd += ["-s", "ncmls.db"]
+    start = time.perf_counter()
+    p = subprocess.run(cmd, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    elapsed = time.perf_counter() - start
+    shutil.rmtree(cwd)
+
+    m = re.search(r"(\d+) written", p.stderr)
+    n = int(m.group(1)) if m else 0
+    return {"stage": "ncmls", "jobs": jobs, "time": elapsed, "items": n, "rate": n / elapsed,
+            "db_size": db_size(database), "errors": 0}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Records/s of search.py and aggregations/s of ncmls.py against mock index nodes.")
+    parser.add_argument("-j", "--jobs",
+                        nargs="+",
+                        type=int,
+                        required=False,
+                        default=[1, 2, 4, 8],
+                        help="numbers of jobs of search.py and ncmls.py.")
+    parser.add_argument("--pages",
+                        type=int,
+                        required=False,
+                        default=1,
+                        help="pages of a query requested concurrently by search.py.")
+    parser.add_argument("-n", "--normalized",
+                        action="store_true",
+                        default=False,
+                        help="harvest into the normalized layout.")
+    parser.add_argument("-p", "--project",
+                        nargs="+",
+                        type=str,
+                        required=False,
+                        default=["esgf_ensemble"],
+                        help="types of ESGF Virtual Aggregation generated by ncmls.py.")
+    parser.add_argument("--store",
+                        action="store_true",
+                        default=False,
+                        help="write the NcMLs to a store instead of files.")
+    parser.add_argument("--index-nodes",
+                        type=int,
+                        required=False,
+                        default=2,
+                        help="number of mock index nodes.")
+    parser.add_argument("--latency",
+                        type=float,
+                        required=False,
+                        default=0,
+                        help="seconds added to each search request.")
+    parser.add_argument("--failures",
+                        type=float,
+                        required=False,
+                        default=0,
+                        help="fraction of page requests answered with 503.")
+    parser.add_argument("--compress",
+                        action="store_true",
+                        default=False,
+                        help="gzip search responses.")
+    parser.add_argument("-d", "--dir",
+                        type=str,
+                        required=False,
+                        default=None,
+                        help="working directory, a temporary one by default.")
+    parser.add_argument("-o", "--output",
+                        type=str,
+                        required=False,
+                        default=None,
+                        help="results file, standard output by default.")
+    mock_index.add_arguments(parser)
+    args = vars(parser.parse_args())
+
+    corpus = mock_index.get_corpus(args)
+    print("{} records, {} index nodes.".format(corpus.size, args["index_nodes"]), file=sys.stderr, flush=True)
+    directory = args["dir"] or tempfile.mkdtemp(prefix="eva-pipeline-")
+    os.makedirs(directory, exist_ok=True)
+    servers = [start_index(corpus, args["latency"], args["failures"], args["compress"], seed)
+               for seed in range(args["index_nodes"])]
+    nodes = [url for _, url in servers]
+
+    out = open(args["output"], "w", newline="") if args["output"] is not None else sys.stdout
+    writer = csv.DictWriter(out, fieldnames=FIELDS)
+    writer.writeheader()
+    try:
+        databases = []
+        for jobs in args["jobs"]:
+            database, result = run_search(directory, jobs, nodes, args["pages"], args["normalized"])
+            databases.append(database)
+            writer.writerow(result)
+            out.flush()
+
+        # every harvest stored the same records, NcMLs are generated from the first one
+        for jobs in args["jobs"]:
+            writer.writerow(run_ncmls(directory, jobs, databases[0], args["project"], args["store"]))
+            out.flush()
+    finally:
+        for p, _ in servers:
+            p.terminate()
+        if out is not sys.stdout:
+            out.close()
+        if args["dir"] is None:
+            shutil.rmtree(directory)
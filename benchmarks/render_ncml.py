@@ -0,0 +1,79 @@
+import argparse
+import csv
+import itertools
+import os
+import sqlite3
+import sys
+import time
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import ncmls
+
+
+def render_jinja(template, columns, rows):
+    df = pd.DataFrame(rows, columns=columns)
+    df["version"] = df["id"].str.replace("\\|.*", "", regex=True).str.split(".").str[-3]
+    return template.render({'df': df, 'coords': ncmls.get_coords(columns, rows)})
+
+
+def render_fast(project, columns, rows):
+    return project.render(ncmls.table(columns, rows), ncmls.get_coords(columns, rows))
+
+
+def measure(f, runs, *args):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        data = f(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return data, best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time to render each aggregation with the templates and with the fast renderer.")
+    parser.add_argument("--database",
+                        required=True,
+                        type=str,
+                        help="database file.")
+    parser.add_argument("-p", "--project",
+                        choices=["esgf_dataset", "esgf_ensemble"],
+                        type=str,
+                        required=False,
+                        default="esgf_ensemble",
+                        help="type of ESGF Virtual Aggregation.")
+    parser.add_argument("-n", "--runs",
+                        type=int,
+                        required=False,
+                        default=3,
+                        help="number of runs, the best one is reported.")
+    parser.add_argument("-l", "--limit",
+                        type=int,
+                        required=False,
+                        default=None,
+                        help="number of aggregations.")
+    args = vars(parser.parse_args())
+
+    project = ncmls.PROJECTS[args["project"]]()
+    env = ncmls.setup_jinja(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    template = env.get_template(os.path.basename(project.template))
+
+    conn = sqlite3.connect(args["database"])
+    query = ncmls.coords_query(ncmls.SCAN) if ncmls.has_coords(conn) else ncmls.SCAN
+    cursor = conn.execute(query.format(project.key))
+    columns = [d[0] for d in cursor.description]
+    k = columns.index(project.key)
+    groups = itertools.islice(
+        (rows for chunk in ncmls.scan(cursor, project.key, 64) for rows in chunk), args["limit"])
+
+    out = csv.writer(sys.stdout)
+    out.writerow(["aggregation", "files", "jinja_time", "fast_time", "identical"])
+    for rows in groups:
+        a, jinja_time = measure(render_jinja, args["runs"], template, columns, rows)
+        b, fast_time = measure(render_fast, args["runs"], project, columns, rows)
+        out.writerow([rows[0][k], len(rows), jinja_time, fast_time, a == b])
+        sys.stdout.flush()
+    conn.close()
@@ -0,0 +1,93 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+import zlib
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import search
+
+
+def decompress(raw, encoding):
+    if encoding == "gzip":
+        return zlib.decompress(raw, 16 + zlib.MAX_WBITS)
+    elif encoding == "deflate":
+        try:
+            return zlib.decompress(raw)
+        except zlib.error:
+            return zlib.decompress(raw, -zlib.MAX_WBITS)
+    return raw
+
+
+def measure(session, url, params, compressed):
+    headers = {"Accept-Encoding": "gzip, deflate" if compressed else "identity"}
+
+    start = time.monotonic()
+    r = session.get(url, params=params, headers=headers, timeout=search.TIMEOUT, stream=True)
+    r.raise_for_status()
+    raw = r.raw.read(decode_content=False)
+    transfer = time.monotonic() - start
+
+    start = time.monotonic()
+    body = decompress(raw, r.headers.get("Content-Encoding", ""))
+    docs = json.loads(body)["response"]["docs"]
+    decode = time.monotonic() - start
+
+    return len(raw), len(body), transfer, decode, len(docs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Bytes and time of a search page with and without field projection and compression.")
+    parser.add_argument("query",
+                        nargs="*",
+                        default=["variable_id=tas", "frequency=day"],
+                        help="search keywords, like in selection files.")
+    parser.add_argument("-i", "--index-node",
+                        type=str,
+                        required=False,
+                        default=search.INDEX,
+                        help="index node.")
+    parser.add_argument("--url",
+                        type=str,
+                        required=False,
+                        default=None,
+                        help="search endpoint, overrides --index-node.")
+    parser.add_argument("-n", "--runs",
+                        type=int,
+                        required=False,
+                        default=3,
+                        help="number of runs.")
+    parser.add_argument("-l", "--limit",
+                        type=int,
+                        required=False,
+                        default=search.LIMIT,
+                        help="documents per page.")
+    args = vars(parser.parse_args())
+
+    url = args["url"] or search.search_url(args["index_node"])
+    params = {
+        "project": "CMIP6",
+        "type": "File",
+        "distrib": "True",
+        "limit": args["limit"],
+        "format": "application/solr+json"}
+    params.update(dict([kv.split("=", 1) for kv in args["query"]]))
+    fields = ",".join(search.Cmip6().fields())
+
+    session = requests.Session()
+    out = csv.writer(sys.stdout)
+    out.writerow(["name", "run", "bytes", "body_bytes", "transfer_time", "decode_time", "docs"])
+    for run in range(args["runs"]):
+        for name, projected, compressed in (
+                ("all fields", False, False),
+                ("all fields, compressed", False, True),
+                ("projected", True, False),
+                ("projected, compressed", True, True)):
+            payload = dict(params, fields=fields) if projected else params
+            out.writerow([name, run] + list(measure(session, url, payload, compressed)))
+            sys.stdout.flush()
+    session.close()
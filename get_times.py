@@ -1,57 +1,165 @@
+import argparse
+import collections
 import netCDF4
-import time
+import sqlite3
 import sys
+import time
 import numpy as np
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
+
+NS = "http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2"
+INTERVAL = 1  # seconds between files of the same host, avoid being blocked by some servers eg: esgf.ceda.ac.uk
+
+
+def createcache(conn):
+    # files are identified by tracking_id when the NcML has it, by location otherwise
+    conn.execute("""CREATE TABLE IF NOT EXISTS coords (
+    key TEXT PRIMARY KEY,
+    location TEXT,
+    ncoords INTEGER,
+    start TEXT,
+    increment TEXT,
+    vals TEXT)""")
+    conn.commit()
+
+
+def get_tracking_ids(tree):
+    """Map of location to tracking_id from the tracking_id variable of the NcML."""
+    tracking_ids = {}
+    for variable in tree.findall('.//{%s}variable[@name="tracking_id"]' % NS):
+        values = variable.find('{%s}values' % NS)
+        if values is None or values.text is None:
+            continue
+        pairs = values.text.split(" ")
+        for location, tracking_id in zip(pairs[::2], pairs[1::2]):
+            if tracking_id != "":
+                tracking_ids[location] = tracking_id
+
+    return tracking_ids
+
+
+def get_times(fname):
+    with netCDF4.Dataset(fname) as nc:
+        times = nc["time"][...].ravel()
+
+    diffs = np.unique(np.diff(times))
+    if len(diffs) == 1:
+        return len(times), str(times[0]), str(diffs[0]), None
+    else:
+        return len(times), None, None, " ".join([str(x) for x in times])
+
+
+def add_times(netcdf_element, ncoords, start, increment, vals):
+    time_el = ET.Element('variable')
+    time_el.attrib["name"] = "time"
+
+    values_el = ET.Element('values')
+    if vals is None:
+        values_el.attrib['increment'] = increment
+        values_el.attrib['start'] = start
+    else:
+        values_el.text = vals
+
+    time_el.append(values_el)
+    netcdf_element.append(time_el)
+    netcdf_element.attrib['ncoords'] = str(ncoords)
+
+
+def fetch(locations, jobs, interval):
+    """Yield the time coordinates of each location, at most one file per host every interval seconds."""
+    hosts = collections.OrderedDict()
+    for location in locations:
+        hosts.setdefault(urlparse(location).netloc, collections.deque()).append(location)
+    ready = dict.fromkeys(hosts, 0)
+
+    with ProcessPoolExecutor(jobs) as executor:
+        running = {}
+        while hosts or running:
+            now = time.monotonic()
+            for host in list(hosts):
+                if len(running) >= jobs:
+                    break
+                if ready[host] > now:
+                    continue
+                location = hosts[host].popleft()
+                if not hosts[host]:
+                    del hosts[host]
+                ready[host] = now + interval
+                print(location, flush=True)
+                running[executor.submit(get_times, location)] = location
+
+            timeout = None
+            if hosts and len(running) < jobs:
+                timeout = max(0, min(ready[host] for host in hosts) - now)
+            if not running:
+                time.sleep(timeout)
+                continue
+
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                location = running.pop(future)
+                try:
+                    yield location, future.result()
+                except Exception as e:
+                    print("Unable to read time from {}: {}".format(location, e), file=sys.stderr, flush=True)
+
 
 if __name__ == "__main__":
-    xml = '''
-    <aggregation type="joinNew" dimName="variant_label">
-        <variableAgg name="tas"></variableAgg>
-        <netcdf coordValue="r10i1p1f2">
-            <aggregation type="joinExisting" dimName="time">
-                <netcdf location="http://esgf-data02.diasjp.net/thredds/dodsC/esg_dataroot/CMIP6/ScenarioMIP/MIROC/MIROC-ES2L/ssp245/r10i1p1f2/3hr/tas/gn/v20210107/tas_3hr_MIROC-ES2L_ssp245_r10i1p1f2_gn_201501010300-201601010000.nc"/>
-            </aggregation>
-        </netcdf>
-    </aggregation>
-    '''
-    
-    ns = "http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2"
-    ET.register_namespace("", ns)
+    parser = argparse.ArgumentParser(description="Add the time coordinates of each file to a NcML.")
+    parser.add_argument("ncml",
+                        type=str,
+                        help="NcML file.")
+    parser.add_argument("-o", "--output",
+                        type=str,
+                        required=False,
+                        default="output.xml",
+                        help="output NcML.")
+    parser.add_argument("-d", "--database",
+                        type=str,
+                        required=False,
+                        default="times.db",
+                        help="cache of time coordinates, may be the database of search.py.")
+    parser.add_argument("-j", "--jobs",
+                        type=int,
+                        required=False,
+                        default=8,
+                        help="number of files read concurrently.")
+    parser.add_argument("--interval",
+                        type=float,
+                        required=False,
+                        default=INTERVAL,
+                        help="seconds between files of the same host.")
+    args = vars(parser.parse_args())
+
+    ET.register_namespace("", NS)
     # Parse XML
-    tree = ET.parse(sys.argv[1])
-    netcdf_elements = tree.findall('.//{http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2}netcdf[@location]')
-    
+    tree = ET.parse(args["ncml"])
+    netcdf_elements = tree.findall('.//{%s}netcdf[@location]' % NS)
+    tracking_ids = get_tracking_ids(tree)
+
+    conn = sqlite3.connect(args["database"])
+    createcache(conn)
+
+    # files already in the cache need no network I/O
+    elements = collections.defaultdict(list)
     for netcdf_element in netcdf_elements:
         fname = netcdf_element.attrib['location']
-        print(fname)
-        with netCDF4.Dataset(fname) as nc:
-            times = nc["time"][...].ravel()
-            time0 = times[0]
-
-            time_el = ET.Element('variable')
-            time_el.attrib["name"] = "time"
-
-            diffs = np.unique(np.diff(times))
-            if len(diffs) == 1:
-                values_el = ET.Element('values')
-                values_el.attrib['increment'] = str(diffs[0])
-                values_el.attrib['start'] = str(time0)
-            else:
-                values_el = ET.Element('values')
-                values_el.text = " ".join([str(x) for x in times])
-
-            time_el.append(values_el)
-            netcdf_element.append(time_el)
-            netcdf_element.attrib['ncoords'] = str(len(times))
-        time.sleep(1) # avoid being blocked by some servers eg: esgf.ceda.ac.uk
-
-    ## Generate modified XML
-    #modified_xml = ET.tostring(tree, encoding='unicode')
-
-    #et = etree.ElementTree(root)
-    #et.write('output.xml', pretty_print=True)
-    #
-    ## Print modified XML
-    #print(modified_xml)
-    tree.write('output.xml')
+        key = tracking_ids.get(fname, fname)
+        cached = conn.execute(
+            "SELECT ncoords, start, increment, vals FROM coords WHERE key = ?", (key,)).fetchone()
+        if cached is not None:
+            add_times(netcdf_element, *cached)
+        else:
+            elements[fname].append(netcdf_element)
+
+    for fname, coords in fetch(list(elements), args["jobs"], args["interval"]):
+        for netcdf_element in elements[fname]:
+            add_times(netcdf_element, *coords)
+        conn.execute("INSERT OR REPLACE INTO coords VALUES (?, ?, ?, ?, ?, ?)",
+                     (tracking_ids.get(fname, fname), fname) + coords)
+        conn.commit()
+    conn.close()
+
+    tree.write(args["output"])
@@ -0,0 +1,282 @@
+import argparse
+import base64
+import io
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import zipfile
+import zlib
+from multiprocessing import Pool
+
+from ncmls import SCAN, scan
+
+KEY = "eva_ensemble_aggregation"  # references are written for each ensemble
+INLINE = 300  # bytes, smaller chunks are stored in the references
+RECORD_SIZE = 10000  # references per parquet file
+EXTENSIONS = {"json": ".json.zip", "parquet": ".parq"}
+
+
+def get_url(opendap):
+    """HTTP download URL of a file from its OPeNDAP URL."""
+    return opendap.rstrip("\n").replace("/thredds/dodsC/", "/thredds/fileServer/", 1)
+
+
+def createcache(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS refs (url TEXT PRIMARY KEY, refs BLOB)")
+    conn.commit()
+
+
+def get_refs(conn, url):
+    row = conn.execute("SELECT refs FROM refs WHERE url = ?", (url,)).fetchone()
+    if row is None:
+        return None
+    return json.loads(zlib.decompress(row[0]))
+
+
+def scan_file(url):
+    """References to the chunks of a netCDF4/HDF5 file, read from its header."""
+    import fsspec
+    from kerchunk.hdf import SingleHdf5ToZarr
+
+    try:
+        with fsspec.open(url, "rb") as f:
+            refs = SingleHdf5ToZarr(f, url, inline_threshold=INLINE).translate()
+            inline_coordinates(refs, f)
+            return url, refs
+    except Exception as e:
+        print("Unable to scan {}: {}".format(url, e), file=sys.stderr, flush=True)
+        return url, None
+
+
+def inline_coordinates(refs, f):
+    # combining references reads the coordinates, keep them so that files are never read again
+    for v, dims in variables(refs).items():
+        if dims != [v]:
+            continue
+        for k, ref in refs["refs"].items():
+            if k.startswith(v + "/") and not k.split("/")[-1].startswith(".") and isinstance(ref, list) and len(ref) == 3:
+                f.seek(ref[1])
+                refs["refs"][k] = "base64:" + base64.b64encode(f.read(ref[2])).decode()
+
+
+def get_members(columns, rows):
+    """Files of each variant_label, like the joinNew/joinExisting aggregations of the esgf_ensemble NcMLs."""
+    label, opendap, frequency = [columns.index(c) for c in ("variant_label", "opendap", "frequency")]
+    members = {}
+    for row in rows:
+        if row[label] is not None:
+            member = members.setdefault(row[label], [[], False])
+            member[0].append(get_url(row[opendap]))
+            member[1] = member[1] or row[frequency] == "fx"
+
+    return [(k, sorted(set(members[k][0])), members[k][1]) for k in sorted(members)]
+
+
+def variables(refs):
+    """Dimensions of each variable in the references."""
+    refs = refs.get("refs", refs)
+    dims = {}
+    for k, v in refs.items():
+        if k.endswith("/.zattrs"):
+            attrs = json.loads(v) if isinstance(v, str) else v
+            dims[k[:-len("/.zattrs")]] = attrs.get("_ARRAY_DIMENSIONS", [])
+
+    return dims
+
+
+def combine(task):
+    """Combined references of an aggregation, files concatenated along time and members along variant_label."""
+    key, variable, members = task
+    try:
+        refs = combine_members(variable, members)
+    except Exception as e:
+        print("Unable to combine {}: {}".format(key, e), file=sys.stderr, flush=True)
+        return key, None
+
+    if refs is None:
+        print("Missing references of some files of {}.".format(key), file=sys.stderr, flush=True)
+    return key, refs
+
+
+def combine_members(variable, members):
+    from kerchunk.combine import MultiZarrToZarr
+
+    conn = sqlite3.connect(cache)
+    combined = []
+    for label, urls, fx in members:
+        refs = [get_refs(conn, url) for url in urls]
+        if any(r is None for r in refs):
+            conn.close()
+            return None
+        if fx or len(refs) == 1:
+            # fx aggregations are unions, all files hold the same variable
+            combined.append(refs[0])
+        else:
+            identical = [v for v, dims in variables(refs[0]).items() if "time" not in dims]
+            combined.append(MultiZarrToZarr(
+                refs, concat_dims=["time"], identical_dims=identical, inline_threshold=INLINE).translate())
+    conn.close()
+
+    # like joinNew, only the aggregated variable gets the new dimension, the rest is taken from the first member
+    identical = [v for v in variables(combined[0]) if v != variable]
+    refs = MultiZarrToZarr(
+        combined,
+        concat_dims=["variant_label"],
+        coo_map={"variant_label": [label for label, _, _ in members]},
+        identical_dims=identical,
+        inline_threshold=INLINE).translate()
+    attrs = json.loads(refs["refs"]["variant_label/.zattrs"])
+    attrs.update({"standard_name": "realization", "_CoordinateAxisType": "Ensemble"})
+    refs["refs"]["variant_label/.zattrs"] = json.dumps(attrs)
+
+    return refs
+
+
+def save(dest, key, refs):
+    path = os.path.join(dest, "{}.json.zip".format(key))
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("{}.json".format(key), json.dumps(refs))
+    with open(tmp, "wb") as fh:
+        fh.write(buf.getvalue())
+    os.replace(tmp, path)
+    print(os.path.abspath(path), flush=True)
+
+
+def save_parquet(dest, key, refs, record_size=RECORD_SIZE):
+    """Write the references as a directory of parquet files, one per variable and range of chunks.
+
+    The directory is opened lazily by fsspec's reference filesystem, only the
+    references of the chunks being read are loaded.
+    """
+    from kerchunk.df import refs_to_dataframe
+
+    path = os.path.join(dest, "{}.parq".format(key))
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    shutil.rmtree(tmp, ignore_errors=True)
+    refs_to_dataframe(refs, tmp, record_size=record_size)
+    if os.path.exists(path):
+        old = "{}.{}.old".format(path, os.getpid())
+        os.rename(path, old)
+        os.rename(tmp, path)
+        shutil.rmtree(old)
+    else:
+        os.rename(tmp, path)
+    print(os.path.abspath(path), flush=True)
+
+
+def load(path):
+    """References of a .json.zip file written by save."""
+    with zipfile.ZipFile(path) as z:
+        return json.loads(z.read(z.namelist()[0]))
+
+
+def init_worker(c):
+    global cache
+    cache = c
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate kerchunk references of the ensemble aggregations.")
+    parser.add_argument("--database",
+                        required=False,
+                        type=str,
+                        help="database file.")
+    parser.add_argument("-d", "--dest",
+                        type=str,
+                        required=False,
+                        default="kerchunks",
+                        help="destination directory.")
+    parser.add_argument("--cache",
+                        type=str,
+                        required=False,
+                        default="kerchunks.db",
+                        help="cache of the references of each file, may be the database of search.py.")
+    parser.add_argument("-j", "--jobs",
+                        type=int,
+                        required=False,
+                        default=8,
+                        help="number of jobs.")
+    parser.add_argument("-c", "--chunk",
+                        type=int,
+                        required=False,
+                        default=16,
+                        help="aggregations whose files are scanned at once.")
+    parser.add_argument("-f", "--force",
+                        action="store_true",
+                        default=False,
+                        help="write the references of all aggregations even if they exist.")
+    parser.add_argument("--format",
+                        choices=list(EXTENSIONS),
+                        type=str,
+                        required=False,
+                        default="json",
+                        help="zipped JSON or a directory of parquet files, loaded lazily.")
+    parser.add_argument("--record-size",
+                        type=int,
+                        required=False,
+                        default=RECORD_SIZE,
+                        help="references per parquet file.")
+    parser.add_argument("--convert",
+                        nargs="+",
+                        type=str,
+                        required=False,
+                        default=None,
+                        help="convert .json.zip files to parquet instead of reading the database.")
+    args = vars(parser.parse_args())
+    if args["database"] is None and args["convert"] is None:
+        parser.error("one of --database or --convert is required.")
+
+    os.makedirs(args["dest"], exist_ok=True)
+    if args["convert"] is not None:
+        for f in args["convert"]:
+            key = os.path.basename(f)
+            if not key.endswith(EXTENSIONS["json"]):
+                print("Skipping {}, not a {} file.".format(f, EXTENSIONS["json"]), file=sys.stderr, flush=True)
+                continue
+            key = key[:-len(EXTENSIONS["json"])]
+            if not args["force"] and os.path.exists(os.path.join(args["dest"], key + EXTENSIONS["parquet"])):
+                continue
+            save_parquet(args["dest"], key, load(f), args["record_size"])
+        sys.exit(0)
+
+    c = sqlite3.connect(args["cache"])
+    createcache(c)
+
+    conn = sqlite3.connect(args["database"])
+    cursor = conn.execute(SCAN.format(KEY))
+    columns = [d[0] for d in cursor.description]
+    variable = columns.index("variable_id")
+
+    with Pool(args["jobs"], initializer=init_worker, initargs=(args["cache"],)) as pool:
+        for chunk in scan(cursor, KEY, args["chunk"]):
+            tasks = []
+            for rows in chunk:
+                key = rows[0][columns.index(KEY)]
+                if not args["force"] and os.path.exists(os.path.join(args["dest"], key + EXTENSIONS[args["format"]])):
+                    continue
+                tasks.append((key, rows[0][variable], get_members(columns, rows)))
+
+            # headers of files not seen before, scanned in parallel and cached so they are never read again
+            urls = set(url for _, _, members in tasks for _, urls, _ in members for url in urls)
+            missing = [url for url in sorted(urls)
+                       if c.execute("SELECT 1 FROM refs WHERE url = ?", (url,)).fetchone() is None]
+            for url, refs in pool.imap_unordered(scan_file, missing):
+                if refs is not None:
+                    c.execute("INSERT OR REPLACE INTO refs VALUES (?, ?)",
+                              (url, zlib.compress(json.dumps(refs).encode())))
+            c.commit()
+
+            for key, refs in pool.imap_unordered(combine, tasks):
+                if refs is None:
+                    continue
+                if args["format"] == "parquet":
+                    save_parquet(args["dest"], key, refs, args["record_size"])
+                else:
+                    save(args["dest"], key, refs)
+
+    conn.close()
+    c.close()
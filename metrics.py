@@ -0,0 +1,249 @@
+import argparse
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import queue
+import threading
+import time
+
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 240)  # seconds
+INTERVAL = 10  # seconds between snapshots
+
+PROFILE = None  # stage profiled with cProfile, see configure
+QUEUE = None  # where worker processes send their metrics, see configure
+profilers = {}
+profilers_lock = threading.Lock()
+
+
+class Metrics:
+    """Counters, gauges and histograms of a process, labelled like Prometheus metrics."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.types = {}
+        self.values = {}
+
+    def key(self, name, kind, labels):
+        self.types.setdefault(name, kind)
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            key = self.key(name, "counter", labels)
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[self.key(name, "gauge", labels)] = value
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            key = self.key(name, "histogram", labels)
+            h = self.values.get(key)
+            if h is None:
+                # a count per bucket, then the sum and the count of all observations
+                h = self.values[key] = [0] * (len(BUCKETS) + 2)
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    h[i] += 1
+                    break
+            h[-2] += value
+            h[-1] += 1
+
+    def reset(self):
+        with self.lock:
+            self.types = {}
+            self.values = {}
+
+    def drain(self):
+        """Types and values recorded since the last drain, to be merged by another process."""
+        with self.lock:
+            drained = (self.types, self.values)
+            self.types = {}
+            self.values = {}
+
+        return drained
+
+    def merge(self, drained):
+        types, values = drained
+        with self.lock:
+            for key, value in values.items():
+                kind = self.types.setdefault(key[0], types[key[0]])
+                if kind == "gauge" or key not in self.values:
+                    self.values[key] = list(value) if kind == "histogram" else value
+                elif kind == "counter":
+                    self.values[key] += value
+                else:
+                    self.values[key] = [a + b for a, b in zip(self.values[key], value)]
+
+    def samples(self):
+        with self.lock:
+            return sorted((key, self.types[key[0]], value) for key, value in self.values.items())
+
+    def json(self):
+        snapshot = {}
+        for (name, labels), kind, value in self.samples():
+            metric = snapshot.setdefault(name, {"type": kind, "samples": []})
+            sample = {"labels": dict(labels)}
+            if kind == "histogram":
+                sample.update(buckets=dict(zip([str(b) for b in BUCKETS] + ["+Inf"], cumulative(value))),
+                              sum=value[-2], count=value[-1])
+            else:
+                sample["value"] = value
+            metric["samples"].append(sample)
+
+        return json.dumps({"timestamp": time.time(), "metrics": snapshot}, indent=1)
+
+    def prometheus(self):
+        lines = []
+        seen = set()
+        for (name, labels), kind, value in self.samples():
+            if name not in seen:
+                lines.append("# TYPE {} {}".format(name, kind))
+                seen.add(name)
+            if kind != "histogram":
+                lines.append("{}{} {}".format(name, format_labels(labels), value))
+                continue
+            for bound, n in zip([str(b) for b in BUCKETS] + ["+Inf"], cumulative(value)):
+                lines.append("{}_bucket{} {}".format(name, format_labels(labels + (("le", bound),)), n))
+            lines.append("{}_sum{} {}".format(name, format_labels(labels), value[-2]))
+            lines.append("{}_count{} {}".format(name, format_labels(labels), value[-1]))
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Snapshot in the Prometheus text format if path ends in .prom, JSON otherwise."""
+        data = self.prometheus() if path.endswith(".prom") else self.json()
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+
+def cumulative(histogram):
+    counts = []
+    n = 0
+    for c in histogram[:-2]:
+        n += c
+        counts.append(n)
+    counts.append(histogram[-1])
+
+    return counts
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels) + "}"
+
+
+METRICS = Metrics()
+
+
+def configure(profile=None, q=None):
+    """Select the stage profiled with cProfile, and the queue of a worker process."""
+    global PROFILE, QUEUE
+    PROFILE = profile
+    QUEUE = q
+
+
+@contextlib.contextmanager
+def stage(name, **labels):
+    """Time a stage into the <name>_seconds histogram, and profile it if it is the selected one."""
+    profiler = None
+    if name == PROFILE:
+        with profilers_lock:
+            profiler = profilers.setdefault(threading.get_ident(), cProfile.Profile())
+    start = time.perf_counter()
+    if profiler is not None:
+        try:
+            profiler.enable()
+        except ValueError:  # since Python 3.12 only one thread is profiled at a time
+            profiler = None
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        METRICS.observe(name + "_seconds", time.perf_counter() - start, **labels)
+
+
+def dump_profile():
+    """Write the profile of the selected stage to <stage>.<pid>.prof, while the stage is not running."""
+    with profilers_lock:
+        if PROFILE is None or not profilers:
+            return
+        stats = pstats.Stats(*profilers.values())
+    stats.dump_stats("{}.{}.prof".format(PROFILE, os.getpid()))
+
+
+def report():
+    """Send the metrics of a worker process to the parent, see Exporter."""
+    if QUEUE is not None:
+        QUEUE.put(METRICS.drain())
+    dump_profile()
+
+
+class Exporter(threading.Thread):
+    """Write a snapshot of the metrics every interval seconds, merging the ones sent by worker processes."""
+
+    def __init__(self, path, interval=INTERVAL, q=None, gauges=None):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.queue = q
+        self.gauges = gauges
+        self.stopped = threading.Event()
+
+    def receive(self, timeout):
+        if self.queue is None:
+            self.stopped.wait(timeout)
+            return
+        try:
+            METRICS.merge(self.queue.get(timeout=timeout))
+            while True:
+                METRICS.merge(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+
+    def export(self):
+        if self.gauges is not None:
+            self.gauges()
+        METRICS.write(self.path)
+
+    def run(self):
+        last = time.monotonic()
+        while not self.stopped.is_set():
+            self.receive(0.1)
+            if time.monotonic() - last >= self.interval:
+                self.export()
+                last = time.monotonic()
+
+    def close(self):
+        self.stopped.set()
+        self.join()
+        self.receive(0)
+        self.export()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the functions taking most time in profiles of a stage.")
+    parser.add_argument("profiles",
+                        nargs="+",
+                        type=str,
+                        help="files written with --profile, one per process.")
+    parser.add_argument("-s", "--sort",
+                        type=str,
+                        required=False,
+                        default="cumulative",
+                        help="pstats sort key.")
+    parser.add_argument("-n", "--limit",
+                        type=int,
+                        required=False,
+                        default=30,
+                        help="number of functions.")
+    args = vars(parser.parse_args())
+
+    pstats.Stats(*args["profiles"]).sort_stats(args["sort"]).print_stats(args["limit"])
@@ -0,0 +1,209 @@
+import argparse
+import collections
+import os
+import re
+import sqlite3
+import string
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ncmls import PROJECTS, coords_query, dead_node, has_coords, load_templates, render, split
+from probe import TTL, get_nodes
+
+CACHE = 1024
+
+
+def pattern(dest):
+    """Regular expression matching the paths of a destination template, facets as named groups."""
+    regex = ""
+    seen = set()
+    for literal, field, _, _ in string.Formatter().parse(dest):
+        regex += re.escape(literal)
+        if field is None:
+            continue
+        if field in seen:
+            regex += "(?P={})".format(field)
+        else:
+            regex += "(?P<{}>[^/]+?)".format(field)
+            seen.add(field)
+
+    return re.compile(regex)
+
+
+class LRU:
+    """Bounded cache of NcMLs by path, emptied when the database changes."""
+
+    def __init__(self, size, database):
+        self.size = size
+        self.files = [database, database + "-wal"]
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.version = self.stat()
+
+    def stat(self):
+        version = []
+        for f in self.files:
+            try:
+                st = os.stat(f)
+                version.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                version.append(None)
+
+        return version
+
+    def get(self, path):
+        with self.lock:
+            version = self.stat()
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+            if path in self.entries:
+                self.entries.move_to_end(path)
+                return self.entries[path]
+
+        return None
+
+    def put(self, path, data, version):
+        with self.lock:
+            # rendered from an older database
+            if version != self.version:
+                return
+            self.entries[path] = data
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class Renderer:
+    """Render the NcML of a path from the database, like ncmls.py would write it."""
+
+    def __init__(self, database, projects, renderer="auto", dead_nodes="flag", ttl=TTL):
+        self.database = database
+        self.projects = projects
+        self.dead_nodes = dead_nodes
+        self.ttl = ttl
+        self.templates, self.renderers, _ = load_templates(projects, renderer)
+        self.patterns = [(p, pattern(dest)) for p in projects.values() for dest in p.dests]
+        self.local = threading.local()
+
+    def conn(self):
+        if not hasattr(self.local, "conn"):
+            self.local.conn = sqlite3.connect("file:{}?mode=ro".format(self.database), uri=True)
+        return self.local.conn
+
+    def render(self, path):
+        for project, regex in self.patterns:
+            m = regex.fullmatch(path)
+            if m is None:
+                continue
+
+            prefix = project.key_prefix(m.groupdict())
+            query = project.query_prefix
+            if has_coords(self.conn()):
+                query = coords_query(query)
+            cursor = self.conn().execute(query, {"prefix": prefix, "end": prefix + "\U0010ffff"})
+            columns = [d[0] for d in cursor.description]
+            k = columns.index(project.key)
+            aggregations = split(cursor.fetchall(), k)
+            nodes = get_nodes(self.conn(), self.ttl)
+            node = columns.index("data_node")
+            if project.selective:
+                replica = columns.index("replica")
+                chosen = set(project.select(
+                    [(rows[0][k], rows[0][node], min(r[replica] for r in rows)) for rows in aggregations], nodes))
+                aggregations = [rows for rows in aggregations if rows[0][k] in chosen]
+            for rows in aggregations:
+                # same as ncmls.py --dead-nodes
+                dead = dead_node(project, rows[0][node], nodes, self.dead_nodes)
+                if dead == "skip":
+                    continue
+                dest, data = render(project, self.templates[project.name], self.renderers[project.name], columns,
+                                    rows, dead == "flag")
+                if dest == path:
+                    return data
+
+        return None
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0].lstrip("/")
+        data = self.server.cache.get(path)
+        if data is None:
+            version = self.server.cache.stat()
+            try:
+                data = self.server.renderer.render(path)
+            except Exception as e:
+                self.send_error(500, str(e))
+                return
+            if data is None:
+                self.send_error(404)
+                return
+            self.server.cache.put(path, data, version)
+
+        body = data.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve NcMLs rendered on demand from the database.")
+    parser.add_argument("--database",
+                        required=True,
+                        type=str,
+                        help="database file.")
+    parser.add_argument("-p", "--project",
+                        choices=list(PROJECTS),
+                        nargs="+",
+                        type=str,
+                        required=False,
+                        default=list(PROJECTS),
+                        help="types of ESGF Virtual Aggregation.")
+    parser.add_argument("-r", "--renderer",
+                        choices=["auto", "fast", "jinja"],
+                        type=str,
+                        required=False,
+                        default="auto",
+                        help="render NcMLs with the templates or write them directly.")
+    parser.add_argument("--dead-nodes",
+                        choices=["flag", "skip", "keep"],
+                        type=str,
+                        required=False,
+                        default="flag",
+                        help="NcMLs of the data nodes that did not answer the last probes (see probe.py) are "
+                             "flagged with an attribute, not served, or served as usual.")
+    parser.add_argument("--ttl",
+                        type=float,
+                        required=False,
+                        default=TTL,
+                        help="seconds the probes of a data node are trusted.")
+    parser.add_argument("--host",
+                        type=str,
+                        required=False,
+                        default="127.0.0.1",
+                        help="address to listen on.")
+    parser.add_argument("--port",
+                        type=int,
+                        required=False,
+                        default=8080,
+                        help="port to listen on.")
+    parser.add_argument("-c", "--cache",
+                        type=int,
+                        required=False,
+                        default=CACHE,
+                        help="number of NcMLs kept in memory.")
+    args = vars(parser.parse_args())
+
+    projects = {name: PROJECTS[name]() for name in args["project"]}
+    server = ThreadingHTTPServer((args["host"], args["port"]), Handler)
+    server.renderer = Renderer(args["database"], projects, args["renderer"], args["dead_nodes"], args["ttl"])
+    server.cache = LRU(args["cache"], args["database"])
+    print("Serving NcMLs from {} at http://{}:{}/".format(args["database"], args["host"], args["port"]), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -0,0 +1,102 @@
+import argparse
+import os
+import sqlite3
+import sys
+import zlib
+
+TIMEOUT = 300
+
+
+class Store:
+    """NcMLs packed in a single sqlite file, compressed and keyed by their destination path."""
+
+    def __init__(self, path, timeout=TIMEOUT):
+        # several ncmls.py jobs write to the same store
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.execute("PRAGMA journal_mode=WAL").fetchone()
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS ncmls (path TEXT PRIMARY KEY, data BLOB) WITHOUT ROWID")
+        self.conn.commit()
+
+    def put(self, path, data):
+        self.conn.execute("INSERT OR REPLACE INTO ncmls VALUES (?, ?)", (path, zlib.compress(data.encode())))
+
+    def get(self, path):
+        row = self.conn.execute("SELECT data FROM ncmls WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        return zlib.decompress(row[0]).decode()
+
+    def exists(self, path):
+        return self.conn.execute("SELECT 1 FROM ncmls WHERE path = ?", (path,)).fetchone() is not None
+
+    def remove(self, path):
+        return self.conn.execute("DELETE FROM ncmls WHERE path = ?", (path,)).rowcount > 0
+
+    def paths(self, prefix=""):
+        # range scan over the primary key
+        cursor = self.conn.execute(
+            "SELECT path FROM ncmls WHERE path >= ? AND path < ? ORDER BY path", (prefix, prefix + "\U0010ffff"))
+        for row in cursor:
+            yield row[0]
+
+    def export(self, dest, prefix=""):
+        """Materialize the NcMLs under prefix as files in dest."""
+        n = 0
+        cursor = self.conn.execute(
+            "SELECT path, data FROM ncmls WHERE path >= ? AND path < ? ORDER BY path", (prefix, prefix + "\U0010ffff"))
+        for path, data in cursor:
+            abspath = os.path.abspath(os.path.join(dest, path))
+            os.makedirs(os.path.dirname(abspath), exist_ok=True)
+            tmp = "{}.{}.tmp".format(abspath, os.getpid())
+            with open(tmp, "wb") as fh:
+                fh.write(zlib.decompress(data))
+            os.replace(tmp, abspath)
+            print(abspath, flush=True)
+            n += 1
+
+        return n
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Read NcMLs from a store written by ncmls.py --store.")
+    parser.add_argument("store",
+                        type=str,
+                        help="store file.")
+    parser.add_argument("action",
+                        choices=["ls", "get", "export"],
+                        type=str,
+                        help="list paths, print a NcML or write NcMLs as files.")
+    parser.add_argument("path",
+                        nargs="?",
+                        default="",
+                        type=str,
+                        help="path of the NcML (get) or path prefix (ls, export).")
+    parser.add_argument("-d", "--dest",
+                        type=str,
+                        required=False,
+                        default=".",
+                        help="destination directory of export.")
+    args = vars(parser.parse_args())
+
+    store = Store(args["store"])
+    if args["action"] == "ls":
+        for path in store.paths(args["path"]):
+            print(path)
+    elif args["action"] == "get":
+        data = store.get(args["path"])
+        if data is None:
+            print("{} not found.".format(args["path"]), file=sys.stderr)
+            sys.exit(1)
+        sys.stdout.write(data)
+    else:
+        n = store.export(args["dest"], args["path"])
+        print("Exported {} NcMLs.".format(n), file=sys.stderr)
+    store.close()
@@ -1,20 +1,98 @@
 import argparse
+import hashlib
+import itertools
 import os
 import re
 import sqlite3
+import sys
 import pandas as pd
-from multiprocessing import Pool
+from multiprocessing import Pool, Queue
 from jinja2 import Environment, FileSystemLoader, ChoiceLoader, select_autoescape
+from jinja2.filters import do_filesizeformat
+from ncml_store import Store
+import metrics
+import probe
+from search import get_latest, split_key
+
+# the fast renderer writes the same bytes as the bundled templates, keep them in sync
+HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<netcdf xmlns="http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2">
+    <explicit/>
+{status}    <attribute name="size" type="int" value="{size}"{space}/>
+    <attribute name="size_human" value="{size_human}"{space}/>
+
+    <attribute name="__info__"
+               value="Virtual dataset generated by the ESGF Virtual Aggregation"/>
+    <attribute name="__license__"
+               value="This is a derived dataset product from ESGF, same licenses from original datasets apply for this dataset."/>
+
+    <!-- only mandatory (when required? = always) attributes from
+         http://cerfacs.fr/~coquart/data/uploads/cmip6_global_attributes_filenames_cvs_v6.2.6.pdf
+         are included -->
+    <!-- mandatory attributes are extracted from netcdf files
+         BUT creation_date and further_info_url have got custom values relative to EVA -->"""
+ATTRS = ("activity_id", "Conventions", "data_specs_version", "experiment", "experiment_id", "forcing_index",
+         "frequency", "grid", "grid_label", "initialization_index", "institution", "institution_id", "license",
+         "mip_era", "nominal_resolution", "physics_index", "product", "realization_index", "realm",
+         "source", "source_id", "source_type", "sub_experiment", "sub_experiment_id", "table_id",
+         "variable_id", "variant_label", "cmor_version")
+NO_PARENT_ATTRS = ("branch_method", "parent_activity_id", "parent_experiment_id", "parent_mip_era",
+                   "parent_source_id", "parent_time_units", "parent_variant_label")
+OMIT_ATTRS = ("branch_time_in_child", "branch_time_in_parent")
+
+
+# time coordinates of each file, from get_times.py
+COORDS = """select c.*, k.ncoords, k.start as time_start, k.increment as time_increment, k.vals as time_values
+from cmip6 c left join coords k
+on k.key = case when c.tracking_id is null or c.tracking_id = '' then c.opendap else c.tracking_id end"""
+
+# products are generated from a scan ordered by their key, those with the same key share it. An esgf_dataset
+# is not always within an ensemble: DCPP sub-experiments share the variant_label
+SCAN = "select * from cmip6 where opendap != \"\" order by {}"
+# copies of each aggregation, to choose among them, see Project.select
+COPIES = "select {0}, data_node, min(replica) from cmip6 where opendap != \"\" group by {0}"
+# added to the NcMLs of data nodes that did not answer the last probes, see probe.py and dead_node
+UNAVAILABLE = '    <attribute name="eva_data_node_status" value="unavailable"/>'
 
 
 class Project:
+    selective = False  # only some copies of each aggregation are written, see select
+    chosen = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
     def template(self):
-        raise NotImplementedError
+        return self._template
 
+    @property
     def query_dataset(self):
-        raise NotImplementedError
+        return self._query_dataset
 
+    @property
     def query_datasets(self):
+        return self._query_datasets
+
+    @property
+    def query_datasets_normalized(self):
+        return self._query_datasets_normalized
+
+    @property
+    def query_prefix(self):
+        return self._query_prefix
+
+    @property
+    def key(self):
+        return self._key
+
+    @property
+    def dests(self):
+        return [self._dest_master, self._dest_replica]
+
+    def key_prefix(self, facets):
+        """Prefix of the keys of the aggregations that may be written to a path with these facets."""
         raise NotImplementedError
 
     def dest_master(self, df):
@@ -23,45 +101,169 @@ class Project:
     def dest_replica(self, df):
         raise NotImplementedError
 
+    def render(self, t, coords, unavailable=False):
+        raise NotImplementedError
+
+    def select(self, copies, nodes):
+        """Keys of the aggregations written among copies, (key, data_node, replica), given the data nodes status."""
+        return [key for key, _, _ in copies]
+
 
 class CMIP6Dataset(Project):
     def __init__(self):
+        self._name = "esgf_dataset"
         self._template = "templates/esgf_dataset.ncml.j2"
         self._query_dataset = "select * from cmip6 where eva_esgf_dataset = :dataset and opendap != \"\""
         self._query_datasets = "select distinct(eva_esgf_dataset) from cmip6"
+        self._query_datasets_normalized = "select eva_esgf_dataset from esgf_datasets"
+        self._query_prefix = "select * from cmip6 where eva_esgf_dataset >= :prefix and eva_esgf_dataset < :end and opendap != \"\""
+        self._key = "eva_esgf_dataset"
         self._dest_master = "content/thredds/public/esgeva/variable/CMIP6/{activity_id}/{table_id}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{variant_label}_{table_id}_{grid_label}_{version}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{member_id}_{table_id}_{variable_id}_{grid_label}_{version}_{data_node}.ncml"
         self._dest_replica = "content/thredds/public/esgeva/variable/CMIP6/{activity_id}/{table_id}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{variant_label}_{table_id}_{grid_label}_{version}/replicas/{data_node}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{member_id}_{table_id}_{variable_id}_{grid_label}_{version}_{data_node}.ncml"
 
+    def key_prefix(self, facets):
+        return "_".join([facets[f] for f in (
+            "mip_era", "activity_id", "institution_id", "source_id", "experiment_id", "variant_label", "table_id",
+            "variable_id", "grid_label", "version", "data_node")])
+
+    def dest_master(self, df):
+        return self._dest_master
+
+    def dest_replica(self, df):
+        return self._dest_replica
+
+    def render(self, t, coords, unavailable=False):
+        lines = header(t, ATTRS, NO_PARENT_ATTRS, " ", unavailable)
+        opendap = t["opendap"]
+        if "fx" in t["frequency"]:
+            for f in dict.fromkeys(opendap):
+                lines.append('    <aggregation type="union">')
+                lines.append('        <netcdf location="{}"/>'.format(f))
+                lines.append('    </aggregation>')
+        else:
+            lines.append('    <aggregation type="joinExisting" dimName="time">')
+            for f in sorted(set(opendap)):
+                if f in coords:
+                    lines.extend(coords_lines(8, f, coords[f]))
+                else:
+                    lines.append('        <netcdf location="{}"/>'.format(f))
+            lines.append('    </aggregation>')
+        lines.append('</netcdf>')
+
+        return "\n".join(lines)
+
 
 class CMIP6Ensemble(Project):
     def __init__(self):
+        self._name = "esgf_ensemble"
         self._template = "templates/esgf_ensemble.ncml.j2"
         self._query_dataset = "select * from cmip6 where eva_ensemble_aggregation = :dataset and opendap != \"\""
         self._query_datasets = "select distinct(eva_ensemble_aggregation) from cmip6"
+        self._query_datasets_normalized = "select eva_ensemble_aggregation from ensemble_aggregations"
+        self._query_prefix = "select * from cmip6 where eva_ensemble_aggregation >= :prefix and eva_ensemble_aggregation < :end and opendap != \"\""
+        self._key = "eva_ensemble_aggregation"
+        self._dest_master = "content/thredds/public/esgeva/ensemble/CMIP6/{activity_id}/{table_id}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{table_id}_{grid_label}_{version}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{table_id}_{variable_id}_{grid_label}_{version}.ncml"
+        self._dest_master_sub_experiment = "content/thredds/public/esgeva/ensemble/CMIP6/{activity_id}/{table_id}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{table_id}_{grid_label}_{version}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{sub_experiment_id}_{table_id}_{variable_id}_{grid_label}_{version}.ncml"
+        self._dest_replica = "content/thredds/public/esgeva/ensemble/CMIP6/{activity_id}/{table_id}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{table_id}_{grid_label}_{version}/replicas/{data_node}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{table_id}_{variable_id}_{grid_label}_{version}.ncml"
+        self._dest_replica_sub_experiment = "content/thredds/public/esgeva/ensemble/CMIP6/{activity_id}/{table_id}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{table_id}_{grid_label}_{version}/replicas/{data_node}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{sub_experiment_id}_{table_id}_{variable_id}_{grid_label}_{version}.ncml"
 
     @property
-    def template(self):
-        return self._template
-
-    @property
-    def query_dataset(self):
-        return self._query_dataset
-
-    @property
-    def query_datasets(self):
-        return self._query_datasets
+    def dests(self):
+        return [self._dest_master, self._dest_master_sub_experiment,
+                self._dest_replica, self._dest_replica_sub_experiment]
+
+    def key_prefix(self, facets):
+        fields = ["mip_era", "activity_id", "institution_id", "source_id", "experiment_id", "table_id",
+                  "variable_id", "grid_label", "version"]
+        if "sub_experiment_id" in facets:
+            fields.insert(5, "sub_experiment_id")
+        # master paths do not include the data node
+        return "_".join([facets[f] for f in fields]) + "_" + facets.get("data_node", "")
 
     def dest_master(self, df):
-        if (df["sub_experiment_id"] == "none").any():
-            return "content/thredds/public/esgeva/ensemble/CMIP6/{activity_id}/{table_id}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{table_id}_{grid_label}_{version}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{table_id}_{variable_id}_{grid_label}_{version}.ncml"
+        if "none" in list(df["sub_experiment_id"]):
+            return self._dest_master
         else:
-            return "content/thredds/public/esgeva/ensemble/CMIP6/{activity_id}/{table_id}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{table_id}_{grid_label}_{version}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{sub_experiment_id}_{table_id}_{variable_id}_{grid_label}_{version}.ncml"
+            return self._dest_master_sub_experiment
 
     def dest_replica(self, df):
-        if (df["sub_experiment_id"] == "none").any():
-            return "content/thredds/public/esgeva/ensemble/CMIP6/{activity_id}/{table_id}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{table_id}_{grid_label}_{version}/replicas/{data_node}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{table_id}_{variable_id}_{grid_label}_{version}.ncml"
+        if "none" in list(df["sub_experiment_id"]):
+            return self._dest_replica
         else:
-            return "content/thredds/public/esgeva/ensemble/CMIP6/{activity_id}/{table_id}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{table_id}_{grid_label}_{version}/replicas/{data_node}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{sub_experiment_id}_{table_id}_{variable_id}_{grid_label}_{version}.ncml"
+            return self._dest_replica_sub_experiment
+
+    def render(self, t, coords, unavailable=False):
+        lines = header(t,
+                       [a for a in ATTRS if a != "variant_label"],
+                       [a for a in NO_PARENT_ATTRS if a != "parent_variant_label"],
+                       "",
+                       unavailable)
+        members = {}
+        for label, f, frequency in zip(t["variant_label"], t["opendap"], t["frequency"]):
+            if label is not None:
+                member = members.setdefault(label, ([], []))
+                member[0].append(f)
+                member[1].append(frequency)
+
+        lines.append('    <dimension name="variant_label" length="{}"/>'.format(len(members)))
+        lines.append('    <variable name="variant_label" shape="variant_label" type="string">')
+        lines.append('        <attribute name="standard_name" value="realization"/>')
+        lines.append('        <attribute name="_CoordinateAxisType" value="Ensemble"/>')
+        lines.append('    </variable>')
+        lines.append('    <aggregation type="joinNew" dimName="variant_label">')
+        lines.append('        <variableAgg name="{}"/>'.format(t["variable_id"][0]))
+        for label in sorted(members):
+            files, frequencies = members[label]
+            if "fx" in frequencies:
+                for f in dict.fromkeys(files):
+                    lines.append('            <netcdf coordValue="{}" location="{}" />'.format(label, f))
+            else:
+                lines.append('            <netcdf coordValue="{}">'.format(label))
+                lines.append('                <aggregation type="joinExisting" dimName="time">')
+                for f in sorted(files):
+                    if f in coords:
+                        lines.extend(coords_lines(20, f.rstrip("\n"), coords[f]))
+                    else:
+                        lines.append('                    <netcdf location="{}"/>'.format(f.rstrip("\n")))
+                lines.append('                </aggregation>')
+                lines.append('            </netcdf>')
+        lines.append('    </aggregation>')
+        lines.append('</netcdf>')
+
+        return "\n".join(lines)
+
+
+class CMIP6BestReplica(CMIP6Ensemble):
+    """Ensemble aggregation of the copy on the fastest healthy data node."""
+    selective = True
+
+    def __init__(self):
+        super().__init__()
+        self._name = "esgf_best_replica"
+        self._dest_master = "content/thredds/public/esgeva/ensemble/CMIP6/{activity_id}/{table_id}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{table_id}_{grid_label}_{version}/best/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{table_id}_{variable_id}_{grid_label}_{version}.ncml"
+        self._dest_master_sub_experiment = "content/thredds/public/esgeva/ensemble/CMIP6/{activity_id}/{table_id}/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{table_id}_{grid_label}_{version}/best/{mip_era}_{activity_id}_{institution_id}_{source_id}_{experiment_id}_{sub_experiment_id}_{table_id}_{variable_id}_{grid_label}_{version}.ncml"
+
+    @property
+    def dests(self):
+        return [self._dest_master, self._dest_master_sub_experiment]
+
+    def dest_replica(self, df):
+        return self.dest_master(df)
+
+    def select(self, copies, nodes):
+        # keys of the copies of an ensemble only differ in the data node
+        ensembles = {}
+        for copy in copies:
+            ensembles.setdefault(copy[0][:-len(copy[1])], []).append(copy)
+
+        return [key for key in (probe.best(c, nodes) for c in ensembles.values()) if key is not None]
+
+
+PROJECTS = {
+    "esgf_dataset": CMIP6Dataset,
+    "esgf_ensemble": CMIP6Ensemble,
+    "esgf_best_replica": CMIP6BestReplica,
+}
 
 
 def setup_jinja(templates):
@@ -85,37 +287,364 @@ def setup_jinja(templates):
     return env
 
 
-def generate_ncml(dataset):
-    conn = get_conn(db)
-    dataset_items = conn.cursor()
-    dataset_items.execute("select * from cmip6 limit 1")
-    item1 = dataset_items.fetchone()
-    columns = [k for k in item1.keys()]
-    dataset_items.close()
+def table(columns, rows):
+    """Rows of an aggregation by column, a plain replacement for the DataFrame used by the templates."""
+    if not rows:
+        return {c: [] for c in columns}
+
+    t = {}
+    for c, values in zip(columns, zip(*rows)):
+        # pandas stores integer columns with missing values as floats
+        if None in values and all(v is None or type(v) is int for v in values) and \
+                any(v is not None for v in values):
+            values = [float("nan") if v is None else float(v) for v in values]
+        t[c] = list(values)
 
-    dataset_items = conn.cursor()
-    dataset_items.execute(project.query_dataset, {"dataset": dataset})
-    df = pd.DataFrame(dataset_items.fetchall(), columns=columns)
-    df["version"] = df["id"].str.replace("\|.*", "", regex=True).str.split(".").str[-3]
-    if len(df) > 0:
-        if (df["replica"] == 0).all():
-            dest = project.dest_master(df)
-        else:
-            dest = project.dest_replica(df)
+    # all rows of an aggregation share the version, parse it once
+    t["version"] = [get_version(t["id"][0])] * len(rows)
+
+    return t
+
+
+def get_coords(columns, rows):
+    """Time coordinates of each file (ncoords, start, increment, values) when they are known."""
+    if "ncoords" not in columns:
+        return {}
+
+    i = [columns.index(c) for c in ("opendap", "ncoords", "time_start", "time_increment", "time_values")]
+    coords = {}
+    for row in rows:
+        if row[i[1]] is not None and row[i[0]] not in coords:
+            coords[row[i[0]]] = tuple(row[k] for k in i[1:])
+
+    return coords
+
+
+def coords_lines(indent, location, coords):
+    ncoords, start, increment, values = coords
+    lines = ['<netcdf location="{}" ncoords="{}">'.format(location, ncoords), '    <variable name="time">']
+    if values is None:
+        lines.append('        <values start="{}" increment="{}"/>'.format(start, increment))
+    else:
+        lines.append('        <values>{}</values>'.format(values))
+    lines.extend(['    </variable>', '</netcdf>'])
+
+    return [" " * indent + line for line in lines]
+
+
+def has_coords(conn):
+    return conn.execute("select 1 from sqlite_master where name = 'coords'").fetchone() is not None
+
+
+def coords_query(query):
+    """Same query over cmip6 plus the time coordinates of each file."""
+    return query.replace("from cmip6", "from ({})".format(COORDS), 1)
 
-        d = dict(df.iloc[0])
-        path = dest.format(**d)
-        abspath = os.path.abspath(path)
-        data = template.render({'df': df})
 
-        os.makedirs(os.path.dirname(abspath), exist_ok=True)
-        with open(abspath, 'w+') as fh:
-            fh.write(data)
+def get_version(id):
+    parts = id.split("|")[0].split(".")
+    return parts[-3] if len(parts) >= 3 else "nan"
 
-        print(abspath, flush=True)
+
+def isna(value):
+    return value is None or value != value
+
+
+def first(values):
+    return next((v for v in values if not isna(v)), None)
+
+
+def header(t, attrs, no_parent_attrs, space, unavailable=False):
+    """Lines common to the dataset and ensemble NcMLs, up to the aggregation."""
+    size = sum(int(s) for s in t["size"])
+    lines = [HEADER.format(size=size, size_human=do_filesizeformat(size, binary=True), space=space,
+                           status=UNAVAILABLE + "\n" if unavailable else "")]
+    for attr in attrs:
+        value = t[attr][0] if attr in t else None
+        lines.append('    <attribute name="{}" value="{}"/>'.format(attr, "" if isna(value) else str(value).replace("\n", " ")))
+    lines.append('    <!-- attributes that default to "no parent" if they don\'t exist -->')
+    for attr in no_parent_attrs:
+        value = first(t[attr]) if attr in t else None
+        lines.append('    <attribute name="{}" value="{}"/>'.format(attr, "no parent" if value is None else str(value).replace("\n", " ")))
+    lines.append('    <!-- attributes that are omitted if they don\'t exist -->')
+    for attr in OMIT_ATTRS:
+        value = first(t[attr]) if attr in t else None
+        if value is not None:
+            lines.append('    <attribute name="{}" value="{}"/>'.format(attr, str(value).replace("\n", " ")))
+    lines.append('')
+    lines.append('    <attribute name="further_info_url" value="See netCDF variable \'further_info_url\'"/>')
+    lines.append('    <attribute name="creation_date" value=""/>')
+    lines.append('    <attribute name="version" value="{}"/>'.format(t["version"][0]))
+    lines.append('    <attribute name="replica" value="{}"/>'.format(str(t["replica"][0]).lower()))
+    lines.append('')
+    lines.append('    <dimension name="nfiles" length="{}"/>'.format(len(t["id"])))
+    lines.append('    <dimension name="file" length="2"/>')
+    if "further_info_url" in t:
+        lines.append('    <variable name="further_info_url" type="string" shape="nfiles file">')
+        lines.append('        <values>{}</values>'.format(
+            " ".join(f + " " + u for f, u in zip(t["opendap"], t["further_info_url"]))))
+        lines.append('    </variable>')
+    if "tracking_id" in t:
+        lines.append('    <variable name="tracking_id" type="string" shape="nfiles file">')
+        lines.append('        <values>{}</values>'.format(
+            " ".join(f + " " + ("" if i is None else i) for f, i in zip(t["opendap"], t["tracking_id"]))))
+        lines.append('    </variable>')
+    lines.append('')
+
+    return lines
+
+
+def load_templates(projects, renderer="auto"):
+    """Template, renderer and hash of the template of each product."""
+    env = setup_jinja(os.path.dirname(__file__))
+    templates = {}
+    renderers = {}
+    template_hashes = {}
+    for name, project in projects.items():
+        templates[name] = env.get_template(os.path.basename(project.template))
+        renderers[name] = renderer
+        if renderer == "auto":
+            default_template = os.path.join(os.path.dirname(__file__), project.template)
+            renderers[name] = "fast" if os.path.samefile(templates[name].filename, default_template) else "jinja"
+        with open(templates[name].filename, "rb") as f:
+            template_hashes[name] = hashlib.sha1(f.read()).hexdigest()
+
+    return templates, renderers, template_hashes
+
+
+def generate_ncml(task):
+    name, dataset = task
+    project = projects[name]
+    conn = get_conn(db)
+    dataset_items = conn.cursor()
+    query = coords_query(project.query_dataset) if has_coords(conn) else project.query_dataset
+    with metrics.stage("ncmls_query", mode="query"):
+        dataset_items.execute(query, {"dataset": dataset})
+        rows = dataset_items.fetchall()
+    columns = [d[0] for d in dataset_items.description]
+    results = write(project, columns, rows)
+    if store is not None:
+        store.commit()
 
     dataset_items.close()
     conn.close()
+    metrics.report()
+
+    return results
+
+
+def generate_ncmls(names, groups):
+    # rows from a scan, shared by the products named, columns are set by init_worker
+    results = []
+    for rows in groups:
+        for project in [projects[name] for name in names]:
+            for aggregation in split(rows, columns.index(project.key)):
+                results.extend(write(project, columns, aggregation))
+    if store is not None:
+        store.commit()
+    metrics.report()
+
+    return results
+
+
+def split(rows, k):
+    groups = {}
+    for row in rows:
+        groups.setdefault(row[k], []).append(row)
+
+    return groups.values()
+
+
+def scan(cursor, key, chunk):
+    """Rows of each aggregation, in chunks of aggregations, from a single ordered query."""
+    k = [d[0] for d in cursor.description].index(key)
+    groups = (list(rows) for _, rows in itertools.groupby(cursor, lambda row: row[k]))
+    return iter(lambda: list(itertools.islice(groups, chunk)), [])
+
+
+def write(project, columns, rows):
+    """Write the NcML of an aggregation, and its latest alias, unless the manifest says they are up to date."""
+    if len(rows) == 0:
+        return []
+
+    key = (project.name, rows[0][columns.index(project.key)])
+    if project.chosen is not None and key[1] not in project.chosen:
+        return []
+
+    data_node = rows[0][columns.index("data_node")]
+    dead = dead_node(project, data_node, nodes, dead_nodes)
+    if dead == "skip":
+        return []
+    unavailable = dead == "flag"
+
+    # only latest versions are chosen in alias mode, their alias has a path without version
+    keys = [key]
+    if versions == "alias":
+        master, version = split_key(key[1], data_node)
+        keys.append((project.name, "{}_latest_{}".format(master, data_node)))
+
+    digest = rows_hash(rows, template_hashes[project.name] + ("unavailable" if unavailable else ""))
+    results = []
+    for k in keys:
+        if k in manifest and manifest[k][0] == digest and exists(manifest[k][1]):
+            metrics.METRICS.inc("ncmls_aggregations_total", product=project.name, result="unchanged")
+            results.append((k, digest, manifest[k][1], False))
+    if len(results) == len(keys):
+        return results
+
+    with metrics.stage("ncmls_render", product=project.name):
+        path, data = render(project, templates[project.name], renderers[project.name], columns, rows, unavailable)
+    unchanged = set([k for k, _, _, _ in results])
+    for k in keys:
+        if k in unchanged:
+            continue
+        dest = path if k == key else path.replace("_" + version, "_latest")
+        with metrics.stage("ncmls_write", product=project.name):
+            save(dest, data)
+        metrics.METRICS.inc("ncmls_aggregations_total", product=project.name, result="written")
+        metrics.METRICS.inc("ncmls_rows_total", len(rows), product=project.name)
+        metrics.METRICS.inc("ncmls_bytes_total", len(data), product=project.name)
+        results.append((k, digest, dest, True))
+
+    return results
+
+
+def dead_node(project, data_node, nodes, dead_nodes="flag"):
+    """"skip" or "flag" if the aggregation is on a data node that did not answer the last probes, None otherwise.
+
+    The copies of selective products are chosen among the healthy data nodes, see Project.select.
+    """
+    status = nodes.get(data_node)
+    if project.selective or status is None or status.available or dead_nodes == "keep":
+        return None
+
+    return dead_nodes
+
+
+def rows_hash(rows, template_hash):
+    # independent of the order of the rows, which is not defined within an aggregation
+    h = hashlib.sha1(template_hash.encode())
+    for row in sorted(repr(tuple(row)) for row in rows):
+        h.update(row.encode())
+        h.update(b"\n")
+
+    return h.hexdigest()
+
+
+def render(project, template, renderer, columns, rows, unavailable=False):
+    """Destination path and NcML of an aggregation, flagged if its data node is unavailable."""
+    coords = get_coords(columns, rows)
+    if renderer == "fast":
+        t = table(columns, rows)
+        dest = get_dest(project, t, {c: values[0] for c, values in t.items()})
+        return dest, project.render(t, coords, unavailable)
+
+    df = pd.DataFrame(rows, columns=columns)
+    df["version"] = df["id"].str.replace("\|.*", "", regex=True).str.split(".").str[-3]
+    dest = get_dest(project, df, dict(df.iloc[0]))
+    return dest, template.render({'df': df, 'coords': coords, 'unavailable': unavailable})
+
+
+def get_dest(project, df, d):
+    if all(r == 0 for r in df["replica"]):
+        dest = project.dest_master(df)
+    else:
+        dest = project.dest_replica(df)
+
+    return dest.format(**d)
+
+
+def save(path, data):
+    if store is not None:
+        store.put(path, data)
+        print(path, flush=True)
+        return
+
+    abspath = os.path.abspath(path)
+    os.makedirs(os.path.dirname(abspath), exist_ok=True)
+    # THREDDS must never read a half written NcML
+    tmp = "{}.{}.tmp".format(abspath, os.getpid())
+    with open(tmp, 'w+') as fh:
+        fh.write(data)
+    os.replace(tmp, abspath)
+
+    print(abspath, flush=True)
+
+
+def exists(path):
+    if store is not None:
+        return store.exists(path)
+    return os.path.exists(path)
+
+
+class Manifest:
+    """Hash of the input rows and path of every NcML written, to skip unchanged aggregations."""
+
+    def __init__(self, path, products, store=None):
+        self.store = store
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS manifest (
+            product TEXT,
+            aggregation TEXT,
+            hash TEXT,
+            path TEXT,
+            PRIMARY KEY (product, aggregation))""")
+        self.entries = {
+            (product, a): (h, p) for product, a, h, p in self.conn.execute(
+                "SELECT product, aggregation, hash, path FROM manifest") if product in products}
+        self.seen = set()
+        self.paths = set()
+        self.written = 0
+        self.unchanged = 0
+        self.removed = 0
+
+    def update(self, results):
+        upsert = []
+        for result in results:
+            if result is None:
+                continue
+            key, digest, path, written = result
+            self.seen.add(key)
+            self.paths.add(path)
+            if not written:
+                self.unchanged += 1
+                continue
+            self.written += 1
+            if key in self.entries and self.entries[key][1] != path:
+                self.remove(self.entries[key][1])
+            upsert.append(key + (digest, path))
+        self.conn.executemany("INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?)", upsert)
+        self.conn.commit()
+        if self.store is not None:
+            self.store.commit()
+
+    def remove(self, path):
+        if self.store is not None:
+            self.removed += self.store.remove(path)
+        elif os.path.exists(path):
+            os.remove(path)
+            self.removed += 1
+
+    def close(self):
+        # aggregations whose rows are gone from the database
+        stale = [key for key in self.entries if key not in self.seen]
+        for key in stale:
+            # the best replica of an ensemble keeps its path when it moves to another data node
+            if self.entries[key][1] not in self.paths:
+                self.remove(self.entries[key][1])
+        self.conn.executemany("DELETE FROM manifest WHERE product = ? AND aggregation = ?", stale)
+        self.conn.commit()
+        self.conn.close()
+        if self.store is not None:
+            self.store.close()
+        print("{} written, {} unchanged, {} removed.".format(self.written, self.unchanged, self.removed),
+              file=sys.stderr, flush=True)
+
+
+def is_normalized(conn):
+    # search.py -n stores cmip6 as a view over normalized tables
+    row = conn.execute("select type from sqlite_master where name = 'cmip6'").fetchone()
+    return row is not None and row[0] == "view"
 
 
 def get_conn(db):
@@ -125,21 +654,26 @@ def get_conn(db):
     return conn
 
 
-def init_worker(d, p):
-    global db, project
+def init_worker(d, p, c=None, s=None, q=None, profile=None):
+    global db, projects, columns, store
     db = d
-    project = p
+    projects = p
+    columns = c
+    store = None if s is None else Store(s)
+    metrics.METRICS.reset()  # forked with the metrics of the parent
+    metrics.configure(profile, q)
 
 
 if __name__ == "__main__":
     # arguments
     parser = argparse.ArgumentParser(description="Query ESGF files and store results in sqlite.")
     parser.add_argument("-p", "--project",
-                        choices=["esgf_dataset", "esgf_ensemble"],
+                        choices=["esgf_dataset", "esgf_ensemble", "esgf_best_replica"],
+                        nargs="+",
                         type=str,
                         required=False,
-                        default="esgf_ensemble",
-                        help="type of ESGF Virtual Aggregation.")
+                        default=["esgf_ensemble"],
+                        help="types of ESGF Virtual Aggregation, those with the same aggregations share a scan.")
     parser.add_argument("--database",
                         required=True,
                         type=str,
@@ -154,28 +688,167 @@ if __name__ == "__main__":
                         required=False,
                         default=8,
                         help="number of jobs.")
+    parser.add_argument("-m", "--mode",
+                        choices=["scan", "query"],
+                        type=str,
+                        required=False,
+                        default="scan",
+                        help="read the database in a single ordered scan, or query each aggregation.")
+    parser.add_argument("-c", "--chunk",
+                        type=int,
+                        required=False,
+                        default=64,
+                        help="aggregations sent to a job at once in scan mode.")
+    parser.add_argument("-r", "--renderer",
+                        choices=["auto", "fast", "jinja"],
+                        type=str,
+                        required=False,
+                        default="auto",
+                        help="render NcMLs with the templates or write them directly (same output, faster), "
+                             "auto uses the fast renderer unless the templates are overridden.")
+    parser.add_argument("--manifest",
+                        type=str,
+                        required=False,
+                        default="manifest.db",
+                        help="manifest of the NcMLs written, unchanged aggregations are skipped in the next run.")
+    parser.add_argument("-s", "--store",
+                        type=str,
+                        required=False,
+                        default=None,
+                        help="pack the NcMLs in this store instead of writing files, see ncml_store.py.")
+    parser.add_argument("-f", "--force",
+                        action="store_true",
+                        default=False,
+                        help="write all NcMLs even if they are up to date.")
+    parser.add_argument("--versions",
+                        choices=["all", "latest", "alias"],
+                        type=str,
+                        required=False,
+                        default="all",
+                        help="write every version of the aggregations, only the latest one, or the latest one and "
+                             "an alias with \"latest\" instead of the version in its path.")
+    parser.add_argument("--dead-nodes",
+                        choices=["flag", "skip", "keep"],
+                        type=str,
+                        required=False,
+                        default="flag",
+                        help="NcMLs of the data nodes that did not answer the last probes (see probe.py) are "
+                             "flagged with an attribute, not written, or written as usual.")
+    parser.add_argument("--ttl",
+                        type=float,
+                        required=False,
+                        default=probe.TTL,
+                        help="seconds the probes of a data node are trusted.")
+    parser.add_argument("--metrics",
+                        type=str,
+                        required=False,
+                        default=None,
+                        help="write metrics to this file periodically, in the Prometheus text format if it ends in .prom, "
+                             "JSON otherwise.")
+    parser.add_argument("--metrics-interval",
+                        type=float,
+                        required=False,
+                        default=metrics.INTERVAL,
+                        help="seconds between metrics snapshots.")
+    parser.add_argument("--profile",
+                        type=str,
+                        required=False,
+                        default=None,
+                        choices=["ncmls_query", "ncmls_render", "ncmls_write"],
+                        help="profile this stage with cProfile, written to <stage>.<pid>.prof by each job.")
     parser.set_defaults()
     args = vars(parser.parse_args())
 
-    # project
-    project = CMIP6Ensemble()
+    # projects
+    projects = {}
+    for name in args["project"]:
+        projects[name] = PROJECTS[name]()
 
     # start ncmls
-    env = setup_jinja(os.path.dirname(__file__))
-    template = env.get_template(os.path.basename(project.template))
+    templates, renderers, template_hashes = load_templates(projects, args["renderer"])
+
+    m = Manifest(args["manifest"], projects, None if args["store"] is None else Store(args["store"]))
+    manifest = {} if args["force"] else m.entries
+
+    # jobs send their metrics to the exporter
+    metrics.configure(args["profile"])
+    q = None
+    exporter = None
+    if args["metrics"]:
+        q = Queue()
+        exporter = metrics.Exporter(args["metrics"], args["metrics_interval"], q)
+        exporter.start()
 
     conn = sqlite3.connect(args["database"])
-    conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
 
-    datasets = [d[0] for d in cursor.execute(project.query_datasets).fetchall()]
-
+    # status of the data nodes, shared with the jobs like the manifest
+    nodes = probe.get_nodes(conn, args["ttl"])
+    dead_nodes = args["dead_nodes"]
+    versions = args["versions"]
+    if versions != "all" and not cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'eva_latest'").fetchone():
+        parser.error("--versions {} needs the version index, update the database with search.py -i.".format(versions))
+    for project in projects.values():
+        if project.selective:
+            copies = cursor.execute(COPIES.format(project.key)).fetchall()
+            project.chosen = set(project.select(copies, nodes))
+        if versions != "all":
+            # superseded and retracted versions are not written, search.py keeps them in eva_versions
+            latest = get_latest(cursor, project.key)
+            project.chosen = latest if project.chosen is None else project.chosen & latest
+
+    if args["mode"] == "scan":
+        scans = {}
+        for name, project in projects.items():
+            scans.setdefault(project.key, []).append(name)
+        query = coords_query(SCAN) if has_coords(conn) else SCAN
+        columns = [d[0] for d in cursor.execute(query.format(next(iter(scans))) + " limit 0").description]
+        with Pool(
+                args["jobs"],
+                initializer=init_worker,
+                initargs=(args["database"], projects, columns, args["store"], q, args["profile"])
+        ) as pool:
+            # bounded number of chunks waiting for a job, Pool.imap would read the whole table
+            pending = []
+            for key, names in scans.items():
+                with metrics.stage("ncmls_query", mode="scan"):
+                    cursor.execute(query.format(key))
+                chunks = scan(cursor, key, args["chunk"])
+                while True:
+                    with metrics.stage("ncmls_query", mode="scan"):
+                        chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    pending.append(pool.apply_async(generate_ncmls, (names, chunk)))
+                    if len(pending) >= 4 * args["jobs"]:
+                        m.update(pending.pop(0).get())
+            for result in pending:
+                m.update(result.get())
+            # let the jobs exit, so their last metrics are flushed
+            pool.close()
+            pool.join()
+    else:
+        datasets = []
+        for name, project in projects.items():
+            if is_normalized(conn):
+                query_datasets = project.query_datasets_normalized
+            else:
+                query_datasets = project.query_datasets
+            datasets.extend((name, d[0]) for d in cursor.execute(query_datasets).fetchall()
+                            if project.chosen is None or d[0] in project.chosen)
+
+        with Pool(
+                args["jobs"],
+                initializer=init_worker,
+                initargs=(args["database"], projects, None, args["store"], q, args["profile"])
+        ) as pool:
+            m.update(itertools.chain.from_iterable(pool.imap_unordered(generate_ncml, datasets)))
+            pool.close()
+            pool.join()
+
+    m.close()
+    if exporter is not None:
+        exporter.close()
+    metrics.dump_profile()
     cursor.close()
     conn.close()
-
-    with Pool(
-            args["jobs"],
-            initializer=init_worker,
-            initargs=(args["database"], project)
-    ) as pool:
-        pool.map(generate_ncml, datasets)
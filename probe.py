@@ -0,0 +1,217 @@
+import argparse
+import collections
+import re
+import sqlite3
+import statistics
+import sys
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+
+TTL = 6 * 3600  # seconds a probe is trusted
+PER_NODE = 3  # files probed per data node
+BYTES = 1 << 20  # bytes of data requested to measure throughput
+TIMEOUT = 30  # seconds
+SIZES = {"Byte": 1, "Int16": 2, "UInt16": 2, "Int32": 4, "UInt32": 4, "Float32": 4, "Float64": 8}
+
+# one file of each aggregation, so that every data node is sampled where it serves data
+SAMPLE = """select data_node, variable_id, min(opendap) from cmip6
+where opendap != "" group by eva_ensemble_aggregation"""
+
+Node = collections.namedtuple("Node", ["available", "latency", "throughput", "checked"])
+
+
+def createprobes(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS probes (
+    url TEXT PRIMARY KEY,
+    data_node TEXT,
+    checked REAL,
+    ok INTEGER,
+    latency REAL,
+    throughput REAL,
+    error TEXT)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS data_nodes (
+    data_node TEXT PRIMARY KEY,
+    checked REAL,
+    probes INTEGER,
+    available INTEGER,
+    latency REAL,
+    throughput REAL)""")
+    conn.commit()
+
+
+def sample(conn, ttl=TTL, per_node=PER_NODE):
+    """(data_node, variable, url) to probe, at most per_node for each data node with no recent probes."""
+    since = time.time() - ttl
+    fresh = collections.Counter([node for node, in conn.execute(
+        "SELECT data_node FROM probes WHERE checked > ?", (since,))])
+
+    selected = []
+    for node, variable, url in conn.execute(SAMPLE):
+        if fresh[node] < per_node:
+            fresh[node] += 1
+            selected.append((node, variable, url))
+
+    return selected
+
+
+def hyperslab(dds, variable, nbytes):
+    """Constraint requesting about nbytes of the variable, along its first dimension."""
+    m = re.search(r"(\w+)\s+{}((?:\[[^\]]*\])+);".format(re.escape(variable)), dds)
+    if m is None:
+        return None
+
+    shape = [int(n) for n in re.findall(r"=\s*(\d+)\]", m.group(2))]
+    if not shape:
+        return variable
+
+    step = SIZES.get(m.group(1), 4)
+    for n in shape[1:]:
+        step *= n
+    k = max(1, min(shape[0], nbytes // max(step, 1)))
+
+    return variable + "".join(["[0:{}]".format(n - 1) for n in [k] + shape[1:]])
+
+
+def probe(session, url, variable, nbytes=BYTES, timeout=TIMEOUT):
+    """Latency of the DDS and throughput of a data request to an OPeNDAP URL."""
+    start = time.monotonic()
+    r = session.get(url + ".dds", timeout=timeout)
+    latency = time.monotonic() - start
+    r.raise_for_status()
+
+    constraint = hyperslab(r.text, variable, nbytes)
+    if constraint is None:
+        return latency, None
+
+    start = time.monotonic()
+    with session.get(url + ".dods?" + constraint, timeout=timeout, stream=True) as r:
+        r.raise_for_status()
+        n = 0
+        for chunk in r.iter_content(65536):
+            n += len(chunk)
+
+    return latency, n / max(time.monotonic() - start, 1e-9)
+
+
+def check(session, node, variable, url, nbytes=BYTES, timeout=TIMEOUT):
+    try:
+        latency, throughput = probe(session, url, variable, nbytes, timeout)
+        return url, node, time.time(), 1, latency, throughput, None
+    except Exception as e:
+        return url, node, time.time(), 0, None, None, str(e)
+
+
+def summarize(conn, ttl=TTL):
+    """Availability, latency and throughput of each data node from its recent probes."""
+    probes = collections.defaultdict(list)
+    for row in conn.execute("SELECT data_node, checked, ok, latency, throughput FROM probes WHERE checked > ?",
+                            (time.time() - ttl,)):
+        probes[row[0]].append(row[1:])
+
+    conn.execute("DELETE FROM data_nodes")
+    for node, rows in probes.items():
+        ok = [r for r in rows if r[1]]
+        latencies = [r[2] for r in ok if r[2] is not None]
+        throughputs = [r[3] for r in ok if r[3] is not None]
+        conn.execute("INSERT INTO data_nodes VALUES (?, ?, ?, ?, ?, ?)", (
+            node, max(r[0] for r in rows), len(rows), len(ok),
+            statistics.median(latencies) if latencies else None,
+            statistics.median(throughputs) if throughputs else None))
+    conn.commit()
+
+
+def get_nodes(conn, ttl=TTL):
+    """Status of the data nodes probed in the last ttl seconds, empty if probe.py never ran."""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'data_nodes'").fetchone() is None:
+        return {}
+
+    return {node: Node(available > 0, latency, throughput, checked)
+            for node, checked, available, latency, throughput in conn.execute(
+                "SELECT data_node, checked, available, latency, throughput FROM data_nodes WHERE checked > ?",
+                (time.time() - ttl,))}
+
+
+def best(copies, nodes):
+    """Key of the copy on the fastest healthy data node, copies are (key, data_node, replica).
+
+    Data nodes that were not probed rank after the healthy ones, and masters
+    before replicas among them. Copies on dead data nodes are never chosen.
+    """
+    def rank(copy):
+        key, node, replica = copy
+        status = nodes.get(node)
+        if status is None:
+            return 0, 0, 0, not replica, key
+        return 1, status.throughput or 0, -(status.latency or 0), not replica, key
+
+    alive = [c for c in copies if c[1] not in nodes or nodes[c[1]].available]
+    if not alive:
+        return None
+
+    return max(alive, key=rank)[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Probe the OPeNDAP service of the data nodes in the database.")
+    parser.add_argument("--database",
+                        required=True,
+                        type=str,
+                        help="database file of search.py.")
+    parser.add_argument("-j", "--jobs",
+                        type=int,
+                        required=False,
+                        default=16,
+                        help="number of files probed concurrently.")
+    parser.add_argument("--ttl",
+                        type=float,
+                        required=False,
+                        default=TTL,
+                        help="seconds a probe is trusted, data nodes probed more recently are not probed again.")
+    parser.add_argument("--per-node",
+                        type=int,
+                        required=False,
+                        default=PER_NODE,
+                        help="files probed per data node, from different aggregations.")
+    parser.add_argument("--bytes",
+                        type=int,
+                        required=False,
+                        default=BYTES,
+                        help="bytes of data requested from each file to measure throughput.")
+    parser.add_argument("--timeout",
+                        type=float,
+                        required=False,
+                        default=TIMEOUT,
+                        help="seconds to wait for a data node.")
+    args = vars(parser.parse_args())
+
+    conn = sqlite3.connect(args["database"])
+    createprobes(conn)
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=args["jobs"], pool_maxsize=args["jobs"])
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    with ThreadPoolExecutor(args["jobs"]) as executor:
+        futures = [executor.submit(check, session, node, variable, url, args["bytes"], args["timeout"])
+                   for node, variable, url in sample(conn, args["ttl"], args["per_node"])]
+        for future in as_completed(futures):
+            result = future.result()
+            if result[6] is not None:
+                print("Unable to probe {}: {}".format(result[0], result[6]), file=sys.stderr, flush=True)
+            else:
+                print(result[0], flush=True)
+            conn.execute("INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?, ?)", result)
+            conn.commit()
+    session.close()
+
+    summarize(conn, args["ttl"])
+    for node, status in sorted(get_nodes(conn, args["ttl"]).items()):
+        print("{}: {}, {} latency, {} throughput".format(
+            node, "available" if status.available else "unavailable",
+            "{:.2f} s".format(status.latency) if status.latency is not None else "unknown",
+            "{:.1f} MB/s".format(status.throughput / 1e6) if status.throughput is not None else "unknown"),
+            file=sys.stderr, flush=True)
+    conn.close()
@@ -1,9 +1,20 @@
 import argparse
+import collections
+import datetime
+import itertools
+import json
 import logging
+import queue
 import re
 import sqlite3
 import sys
+import threading
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+
+import metrics
 
 INDEX_NODES = [
     "esg-dn1.nsc.liu.se",
@@ -19,6 +30,34 @@ SEARCH = "https://{}/esg-search/search".format(INDEX)
 LIMIT = 9000
 TIMEOUT = 240  # seconds
 TOLERANCE = 120  # if each node (6 index nodes) fails 20 times, abort
+EWMA = 0.2  # weight of the last request in the latency and error rate of an index node
+TRIP = 3  # consecutive failures that open the circuit of an index node
+BACKOFF = 30  # seconds an index node is left alone after its circuit opens, doubles on every failed probe
+MAX_BACKOFF = 900  # seconds
+CHUNK = 65536  # bytes of a search response decoded at once
+DOCS = re.compile(r'"docs"\s*:\s*\[')
+SEPARATORS = re.compile(r'[\s,]*')
+# columns of the normalized layout, see createdb
+DATASET_COLUMNS = ("data_node", "index_node", "mip_era", "project", "institution_id", "source_id",
+                   "experiment_id", "table_id", "variable_id", "grid_label", "frequency", "realm", "product",
+                   "variant_label", "member_id", "sub_experiment_id", "activity_id", "further_info_url")
+FILE_COLUMNS = ("id", "version", "checksum", "checksum_type", "instance_id", "master_id", "replica", "size",
+                "timestamp", "title", "tracking_id", "_timestamp", "pid", "opendap", "latest", "retracted")
+FACETS = ("data_node", "table_id", "source_id", "experiment_id", "variable_id", "member_id")  # to split queries
+EPOCH = datetime.datetime(1970, 1, 1)
+END = datetime.datetime(2100, 1, 1)  # fixed upper bound, so windows are the same between runs
+TICK = datetime.timedelta(milliseconds=1)  # precision of Solr dates
+BATCH = 1000  # rows sent to the writer at once
+# aggregation keys whose versions are indexed in eva_versions and eva_latest, see update_versions
+VERSIONED = ("eva_esgf_dataset", "eva_ensemble_aggregation")
+QUEUE = 64  # batches waiting for the writer
+
+
+def search_url(index):
+    # index nodes are host names, or URLs when the scheme is not https (eg: a local mock index)
+    if "://" in index:
+        return "{}/esg-search/search".format(index.rstrip("/"))
+    return "https://{}/esg-search/search".format(index)
 
 
 class Project():
@@ -33,21 +72,44 @@ class Project():
     def query(self):
         raise NotImplementedError
 
-    def parse_record(self, record):
+    def get_version(self):
         raise NotImplementedError
 
-    def get_version(self):
+    def fields(self):
+        raise NotImplementedError
+
+    def row(self, record):
+        """Row of the cmip6 table from a search record."""
         raise NotImplementedError
 
 
 class Cmip6(Project):
-    def __init__(self):
+    def __init__(self, nodes=None):
         super().__init__()
+        # facets are requested like pages, from the healthiest index node (see Scheduler.get)
+        self.nodes = nodes if nodes is not None else Scheduler([INDEX])
         self.core = ("id", "version", "checksum", "checksum_type", "data_node", "index_node", "instance_id",
                      "master_id", "replica", "size", "timestamp", "title", "tracking_id", "_timestamp")
         self.project = ("mip_era", "project", "institution_id", "source_id", "experiment_id", "table_id",
                         "variable_id", "grid_label", "frequency", "realm", "product", "variant_label",
                         "further_info_url", "activity_id", "pid", "member_id", "sub_experiment_id")
+        self.status = (("latest", True), ("retracted", False))
+
+        # columns of a row taken from the record, in the order of the cmip6 table
+        self.columns = ("id", "version", "checksum", "checksum_type", "data_node", "index_node", "instance_id",
+                        "master_id", "replica", "size", "timestamp", "title", "tracking_id", "_timestamp",
+                        "mip_era", "project", "institution_id", "source_id", "experiment_id", "table_id",
+                        "variable_id", "grid_label", "frequency", "realm", "product", "variant_label", "member_id",
+                        "sub_experiment_id", "activity_id", "further_info_url", "pid")
+        positions = {field: i for i, field in enumerate(self.columns)}
+        self.replica = positions["replica"]
+        self.size = positions["size"]
+        self.data_node = positions["data_node"]
+        self.sub_experiment = positions["sub_experiment_id"]
+        self.variant_label = positions["variant_label"]
+        # aggregation keys: prefix, then variant_label or sub_experiment_id, then suffix, version and data_node
+        self.prefix = [positions[f] for f in ("project", "activity_id", "institution_id", "source_id", "experiment_id")]
+        self.suffix = [positions[f] for f in ("table_id", "variable_id", "grid_label")]
         self.variables = (
         "ua", "va", "ta", "hus", "pr", "zg", "thetao", "ua", "wap", "tas", "va", "hur", "vo", "uo", "so", "ta", "hus",
         "tos", "thetao", "tasmax")
@@ -62,146 +124,297 @@ class Cmip6(Project):
                 yield {"data_node": datanode, "variable_id": v}
 
     def get_datanodes(self):
-        session = requests.Session()
-        r = session.get(SEARCH, timeout=TIMEOUT, params={
+        response = self.nodes.get({
             "facets": "data_node",
             "project": "CMIP6",
             "limit": 0,
             "format": "application/solr+json"})
-        response = r.json()
-        session.close()
 
         datanodes = response["facet_counts"]["facet_fields"]["data_node"][::2]
         return datanodes
 
     def get_variables_for_datanode(self, datanode):
-        session = requests.Session()
-        r = session.get(SEARCH, timeout=TIMEOUT, params={
+        response = self.nodes.get({
             "facets": "variable_id",
             "project": "CMIP6",
             "data_node": datanode,
             "limit": 0,
             "format": "application/solr+json"})
-        response = r.json()
-        session.close()
 
         variables = response["facet_counts"]["facet_fields"]["variable_id"][::2]
         return variables
 
+    def fields(self):
+        # only the fields used by row are requested
+        return self.core + self.project + tuple([f for f, _ in self.status]) + ("url", "dataset_id")
+
     def get_version(self, dataset_id):
-        version = re.sub("\|.*", "", dataset_id)
-        version = re.sub(".*\.", "", version)
+        return dataset_id.split("|", 1)[0].rsplit(".", 1)[-1]
 
-        return version
+    def row(self, record):
+        """Row of the cmip6 table from a search record, in a single pass over its fields.
 
-    def parse_record(self, record):
-        row = {}
+        Index nodes return most fields as lists of one value, but not all of
+        them do, so the first value is taken from any list.
+        """
+        row = []
+        for field in self.columns:
+            try:
+                value = record[field]
+            except KeyError:
+                logging.error("Missing field: {} in {}.".format(field, record))
+                value = ""
+            if isinstance(value, list):
+                value = value[0] if value else ""
+            row.append(value)
 
-        for field in self.core:
-            if field not in record:
-                logging.error(
-                    "Missing CORE field: {} in {}.".format(field, record))
-                row[field] = ""
-            elif isinstance(record[field], list):
-                row[field] = record[field][0]
-            else:
-                row[field] = record[field]
-
-        for field in self.project:
-            if field not in record:
-                row[field] = ""
-                logging.error(
-                    "Missing PROJECT field: {} in {}.".format(field, record))
-            elif isinstance(record[field], list):
-                row[field] = record[field][0]
-            else:
-                row[field] = record[field]
+        row[self.replica] = "1" if row[self.replica] else "0"
+        row[self.size] = str(row[self.size])
 
-        row["opendap"] = ""
-        try:
-            opendap = self.find_opendap_url(record["url"])
-            opendap = re.sub("\|.*", "", opendap)
-            opendap = re.sub("\.html$", "", opendap)
-            row["opendap"] = opendap
-        except:
+        opendap = self.find_opendap_url(record.get("url", ()))
+        if not opendap:
             logging.error("Missing OPENDAP field in {}.".format(record))
+        opendap = opendap.split("|", 1)[0]
+        if opendap.endswith(".html"):
+            opendap = opendap[:-5]
+        row.append(opendap)
 
-        row["eva_esgf_dataset"] = "_".join([
-            record["project"][0],
-            record["activity_id"][0],
-            record["institution_id"][0],
-            record["source_id"][0],
-            record["experiment_id"][0],
-            record["variant_label"][0],
-            record["table_id"][0],
-            record["variable_id"][0],
-            record["grid_label"][0],
-            self.get_version(record["dataset_id"]),
-            record["data_node"]])
-
-        if record["sub_experiment_id"][0] == "none":
-            row["eva_ensemble_aggregation"] = "_".join([
-                record["project"][0],
-                record["activity_id"][0],
-                record["institution_id"][0],
-                record["source_id"][0],
-                record["experiment_id"][0],
-                record["table_id"][0],
-                record["variable_id"][0],
-                record["grid_label"][0],
-                self.get_version(record["dataset_id"]),
-                record["data_node"]])
+        prefix = "_".join([row[i] for i in self.prefix])
+        suffix = "_".join([row[i] for i in self.suffix] + [
+            self.get_version(record.get("dataset_id", "")), row[self.data_node]])
+        row.append("_".join([prefix, row[self.variant_label], suffix]))  # eva_esgf_dataset
+        if row[self.sub_experiment] == "none":
+            row.append("_".join([prefix, suffix]))  # eva_ensemble_aggregation
         else:
-            row["eva_ensemble_aggregation"] = "_".join([
-                record["project"][0],
-                record["activity_id"][0],
-                record["institution_id"][0],
-                record["source_id"][0],
-                record["experiment_id"][0],
-                record["sub_experiment_id"][0],
-                record["table_id"][0],
-                record["variable_id"][0],
-                record["grid_label"][0],
-                self.get_version(record["dataset_id"]),
-                record["data_node"]])
+            row.append("_".join([prefix, row[self.sub_experiment], suffix]))
 
-        return row
+        # publication status, absent from old index nodes
+        for field, default in self.status:
+            value = record.get(field, default)
+            row.append("1" if (value[0] if isinstance(value, list) else value) else "0")
 
+        return tuple(row)
 
-def range_search(session, stop=None, **kwargs):
-    payload = kwargs
-
-    # how many records?
+def count(session, url, **kwargs):
+    payload = kwargs.copy()
     payload["limit"] = 0
     payload["format"] = "application/solr+json"
-    n = session.get(SEARCH,
-                    params=payload,
-                    timeout=TIMEOUT
-                    ).json()["response"]["numFound"]
+    r = session.get(url, params=payload, timeout=TIMEOUT)
+    r.raise_for_status()
+
+    return r.json()["response"]["numFound"]
+
+
+def parse_timestamp(timestamp):
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"):
+        try:
+            return datetime.datetime.strptime(timestamp, fmt)
+        except ValueError:
+            pass
+
+    raise ValueError("Unknown timestamp format: {}".format(timestamp))
+
+
+def format_timestamp(timestamp):
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%S.") + "{:03d}Z".format(timestamp.microsecond // 1000)
+
+
+def windows(session, url, frm, to, n, **kwargs):
+    """Split [frm, to] on _timestamp until each window holds at most LIMIT records.
+
+    Windows are yielded in time order together with their number of records.
+    Solr date ranges are inclusive on both ends and have millisecond precision,
+    so consecutive windows never overlap nor leave gaps.
+    """
+    if n <= LIMIT or to - frm < 2 * TICK:
+        yield frm, to, n
+        return
+
+    middle = frm + (to - frm) / 2
+    middle = middle - datetime.timedelta(microseconds=middle.microsecond % 1000)
+    for a, b in ((frm, middle), (middle + TICK, to)):
+        params = kwargs.copy()
+        params["from"] = format_timestamp(a)
+        params["to"] = format_timestamp(b)
+        m = count(session, url, **params)
+        if m > 0:
+            yield from windows(session, url, a, b, m, **kwargs)
+
+
+def pages(session, url, n, paging="offset", **kwargs):
+    """Keys and payloads of the pages needed to retrieve the n records matching kwargs.
+
+    With offset paging, pages walk the whole result set by offset. With
+    timestamp paging, the result set is split in _timestamp windows of at
+    most LIMIT records, so no page ever needs a deep offset.
+
+    The key identifies a page between runs. Results are only sorted the same
+    way within an index node, so offset pages are bound to the index node.
+    """
+    if paging == "timestamp":
+        frm = parse_timestamp(kwargs["from"]) if "from" in kwargs else EPOCH
+        to = parse_timestamp(kwargs["to"]) if "to" in kwargs else END
+        for a, b, m in windows(session, url, frm, to, n, **kwargs):
+            for i in range(0, m, LIMIT):
+                payload = kwargs.copy()
+                payload["from"] = format_timestamp(a)
+                payload["to"] = format_timestamp(b)
+                payload["offset"] = i
+                yield json.dumps(payload, sort_keys=True), payload
+    else:
+        for i in range(0, n, LIMIT):
+            payload = kwargs.copy()
+            payload["offset"] = i
+            yield "{}@{}".format(json.dumps(payload, sort_keys=True), url), payload
+
+
+def get_page(session, url, payload):
+    payload["limit"] = LIMIT
+    payload["format"] = "application/solr+json"
+
+    r = session.get(url, params=payload, timeout=TIMEOUT, stream=True)
+    r.raise_for_status()
+    print(r.url, flush=True)
+
+    return r
+
+
+def iter_docs(r):
+    """Documents of a Solr JSON response, decoded while the response arrives.
+
+    Only one chunk of the response and one document are held in memory, so
+    memory does not depend on the page size.
+    """
+    decoder = json.JSONDecoder()
+    decoding = 0
+    docs = 0
+    try:
+        if r.encoding is None:
+            r.encoding = "utf-8"
+        chunks = r.iter_content(CHUNK, decode_unicode=True)
+
+        # skip everything before the list of documents
+        buf = ""
+        for chunk in chunks:
+            buf += chunk
+            match = DOCS.search(buf)
+            if match:
+                buf = buf[match.end():]
+                break
+            buf = buf[-16:]
+        else:
+            raise ValueError("No documents in search response.")
+
+        for chunk in itertools.chain([""], chunks):
+            buf += chunk
+            pos = 0
+            while True:
+                pos = SEPARATORS.match(buf, pos).end()
+                if buf[pos:pos + 1] == "]":
+                    for _ in chunks:  # consume the response, so the connection is reused
+                        pass
+                    return
+                start = time.perf_counter()
+                try:
+                    doc, pos = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    break  # incomplete document, wait for the next chunk
+                finally:
+                    decoding += time.perf_counter() - start
+                docs += 1
+                yield doc
+            buf = buf[pos:]
+
+        raise ValueError("Truncated search response.")
+    finally:
+        node = getattr(r, "node", None) or requests.utils.urlparse(r.url).netloc
+        metrics.METRICS.inc("search_response_bytes_total", r.raw.tell(), index_node=node)
+        metrics.METRICS.inc("search_decode_seconds_total", decoding, index_node=node)
+        metrics.METRICS.inc("search_docs_total", docs, index_node=node)
+        r.close()
+
+
+def range_pages(session, url, stop=None, inflight=1, paging="offset", skip=(), **kwargs):
+    """Pages of the records matching kwargs as (key, docs), in a stable order.
+
+    Up to inflight pages are requested at the same time, and the documents
+    of each page are decoded while it arrives. Pages whose key is in skip
+    are not requested.
+    """
+    # how many records?
+    n = count(session, url, **kwargs)
 
     # if stop < n, restrict
     if stop is not None and stop < n:
         n = stop
 
-    # clean payload and start searching
-    payload = kwargs
-    i = 0
-    while i < n:
-        payload["limit"] = LIMIT
-        payload["format"] = "application/solr+json"
-        payload["offset"] = i
+    executor = ThreadPoolExecutor(inflight)
+    try:
+        futures = collections.deque()
+        for key, payload in pages(session, url, n, paging, **kwargs):
+            if key in skip:
+                continue
+
+            futures.append((key, executor.submit(get_page, session, url, payload)))
+            if len(futures) >= inflight:
+                key, future = futures.popleft()
+                yield key, iter_docs(future.result())
+
+        while futures:
+            key, future = futures.popleft()
+            yield key, iter_docs(future.result())
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        # pages still in flight are closed when they arrive, so their connections go back to the pool
+        for _, future in futures:
+            future.add_done_callback(close_page)
+
+
+def close_page(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
 
-        r = session.get(SEARCH, params=payload, timeout=TIMEOUT)
-        print(r.url, flush=True)
-        for f in r.json()["response"]["docs"]:
-            yield f
+def range_search(session, url, stop=None, inflight=1, paging="offset", **kwargs):
+    docs = (doc for _, page in range_pages(session, url, stop, inflight, paging, **kwargs) for doc in page)
+    return itertools.islice(docs, stop)
 
-        i = i + LIMIT
 
+def layout(cursor):
+    """'table' for the flat layout, 'view' for the normalized one, None if there is no database."""
+    row = cursor.execute("SELECT type FROM sqlite_master WHERE name = 'cmip6'").fetchone()
+    return row[0] if row else None
 
-def createdb(cursor):
-    cursor.execute("DROP TABLE IF EXISTS cmip6")
-    cursor.execute("""CREATE TABLE cmip6 (
+
+def createdb(cursor, incremental=False, resume=False, normalized=False):
+    """Create the database and return whether it uses the normalized layout and whether ids are unique.
+
+    The flat layout is a single cmip6 table with a row per file. The
+    normalized layout stores dataset-level facets once in datasets, the
+    aggregation keys once in esgf_datasets and ensemble_aggregations, and
+    a row per file in files, referencing its dataset by integer key. A
+    cmip6 view joins them with the same columns as the flat table.
+
+    When the database is kept (incremental or resume), its layout is kept.
+    Ids are unique once harvested incrementally, rows are upserted then,
+    also when resuming without -i.
+    """
+    if incremental or resume:
+        existing = layout(cursor)
+        if existing is not None:
+            normalized = existing == "view"
+    else:
+        if layout(cursor) == "view":
+            cursor.execute("DROP VIEW cmip6")
+        for table in ("cmip6", "harvest", "staging", "pages", "eva_versions", "eva_latest",
+                      "files", "datasets", "esgf_datasets", "ensemble_aggregations"):
+            cursor.execute("DROP TABLE IF EXISTS {}".format(table))
+
+    # no effect in the normalized layout, cmip6 is a view
+    if normalized:
+        createnormalized(cursor)
+
+    cursor.execute("""CREATE TABLE IF NOT EXISTS cmip6 (
     id TEXT,
     version TEXT,
     checksum TEXT,
@@ -238,58 +451,255 @@ def createdb(cursor):
     opendap TEXT,
     
     eva_esgf_dataset TEXT,
-    eva_ensemble_aggregation TEXT)""")
+    eva_ensemble_aggregation TEXT,
+    
+    latest INTEGER DEFAULT 1,
+    retracted INTEGER DEFAULT 0)""")
+
+    # high-water mark (max _timestamp stored) of each query, done if stored in this run
+    cursor.execute("""CREATE TABLE IF NOT EXISTS harvest (
+    query TEXT PRIMARY KEY,
+    mark TEXT,
+    updated TEXT,
+    done INTEGER DEFAULT 0)""")
+
+    # databases created before the publication status was stored
+    for table, column, default in (("cmip6", "latest", 1), ("cmip6", "retracted", 0), ("harvest", "done", 0)):
+        if table == "cmip6" and normalized:
+            continue
+        columns = [c[1] for c in cursor.execute("PRAGMA table_info({})".format(table))]
+        if column not in columns:
+            cursor.execute("ALTER TABLE {} ADD COLUMN {} INTEGER DEFAULT {}".format(table, column, default))
+
+    # rows of the queries being harvested and the pages already retrieved
+    cursor.execute("CREATE TABLE IF NOT EXISTS staging AS SELECT '' AS query, * FROM cmip6 WHERE 0")
+    cursor.execute("CREATE INDEX IF NOT EXISTS staging_query ON staging(query)")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS pages (
+    query TEXT,
+    page TEXT,
+    node TEXT,
+    rows INTEGER,
+    PRIMARY KEY (query, page))""")
+
+    createversions(cursor)
+
+    if not resume:
+        cursor.execute("DELETE FROM staging")
+        cursor.execute("DELETE FROM pages")
+        cursor.execute("UPDATE harvest SET done = 0")
+
+    table = "files" if normalized else "cmip6"
+    unique = cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND name = ?", (table + "_id",)).fetchone() is not None
+    if incremental and not unique:
+        # upserts need unique ids, keep the last copy of duplicates
+        cursor.execute("DELETE FROM {0} WHERE rowid NOT IN (SELECT max(rowid) FROM {0} GROUP BY id)".format(table))
+        cursor.execute("CREATE UNIQUE INDEX {0}_id ON {0}(id)".format(table))
+        unique = True
+    createkeyindexes(cursor, normalized)
+    cursor.connection.commit()
+
+    return normalized, unique
+
+
+def createversions(cursor):
+    """Versions of each aggregation and the latest one, kept up to date by the writer.
+
+    Aggregations are grouped by master, their key without version and data
+    node. Databases harvested before the index existed are indexed once.
+    """
+    exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'eva_versions'").fetchone()
+    cursor.execute("""CREATE TABLE IF NOT EXISTS eva_versions (
+    kind TEXT,
+    master TEXT,
+    version TEXT,
+    data_node TEXT,
+    key TEXT,
+    retracted INTEGER,
+    PRIMARY KEY (kind, master, version, data_node))""")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS eva_latest (
+    kind TEXT,
+    master TEXT,
+    version TEXT,
+    PRIMARY KEY (kind, master))""")
+
+    if not exists:
+        update_versions(cursor, [(kind,) + row for kind in VERSIONED for row in cursor.execute(
+            "SELECT {}, data_node, min(retracted) FROM cmip6 GROUP BY 1, 2".format(kind)).fetchall()])
+
+
+def split_key(key, data_node):
+    """Master (the key without version and data node) and version of an aggregation key."""
+    master, _, version = key[:-len(data_node) - 1].rpartition("_")
+    return master, version
+
+
+def update_versions(cursor, rows):
+    """Store the versions in rows, (kind, key, data_node, retracted), and the latest one of their masters.
+
+    The latest version of a master is the newest one with a copy that is not retracted.
+    """
+    versions = []
+    for kind, key, data_node, retracted in rows:
+        versions.append((kind,) + split_key(key, data_node) + (data_node, key, int(retracted)))
+    cursor.executemany("INSERT OR REPLACE INTO eva_versions VALUES (?, ?, ?, ?, ?, ?)", versions)
+
+    masters = set([(kind, master) for kind, master, _, _, _, _ in versions])
+    cursor.executemany("DELETE FROM eva_latest WHERE kind = ? AND master = ?", masters)
+    cursor.executemany("""INSERT INTO eva_latest SELECT kind, master, max(version) FROM eva_versions
+    WHERE kind = ? AND master = ? AND retracted = 0 GROUP BY kind, master""", masters)
+
+
+def get_latest(cursor, kind):
+    """Keys of the aggregations of this kind in their latest version."""
+    return set([key for key, in cursor.execute("""SELECT v.key FROM eva_versions v
+    JOIN eva_latest l ON l.kind = v.kind AND l.master = v.master AND l.version = v.version
+    WHERE v.kind = ? AND v.retracted = 0""", (kind,))])
+
+
+def createnormalized(cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS esgf_datasets (
+    esgf_dataset INTEGER PRIMARY KEY,
+    eva_esgf_dataset TEXT UNIQUE)""")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS ensemble_aggregations (
+    ensemble_aggregation INTEGER PRIMARY KEY,
+    eva_ensemble_aggregation TEXT UNIQUE)""")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS datasets (
+    dataset INTEGER PRIMARY KEY,
+    esgf_dataset INTEGER REFERENCES esgf_datasets,
+    ensemble_aggregation INTEGER REFERENCES ensemble_aggregations,
+    
+    data_node TEXT,
+    index_node TEXT,
+    
+    mip_era TEXT,
+    project TEXT,
+    institution_id TEXT,
+    source_id TEXT,
+    experiment_id TEXT,
+    table_id TEXT,
+    variable_id TEXT,
+    grid_label TEXT,
+    frequency TEXT,
+    realm TEXT,
+    product TEXT,
+    variant_label TEXT,
+    member_id TEXT,
+    sub_experiment_id TEXT,
+    activity_id TEXT,
+    further_info_url TEXT,
+    
+    UNIQUE (esgf_dataset, ensemble_aggregation))""")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS files (
+    id TEXT,
+    dataset INTEGER REFERENCES datasets,
+    version TEXT,
+    checksum TEXT,
+    checksum_type VARCHAR(10),
+    instance_id TEXT,
+    master_id TEXT,
+    replica INTEGER,
+    size UNSIGNED BIG INT,
+    timestamp TEXT,
+    title TEXT,
+    tracking_id TEXT,
+    _timestamp TEXT,
+    pid TEXT,
+    opendap TEXT,
+    latest INTEGER DEFAULT 1,
+    retracted INTEGER DEFAULT 0)""")
+
+    # same columns as the flat cmip6 table
+    cursor.execute("""CREATE VIEW IF NOT EXISTS cmip6 AS SELECT
+    f.id, f.version, f.checksum, f.checksum_type, d.data_node, d.index_node, f.instance_id, f.master_id,
+    f.replica, f.size, f.timestamp, f.title, f.tracking_id, f._timestamp,
+    d.mip_era, d.project, d.institution_id, d.source_id, d.experiment_id, d.table_id, d.variable_id,
+    d.grid_label, d.frequency, d.realm, d.product, d.variant_label, d.member_id, d.sub_experiment_id,
+    d.activity_id, d.further_info_url, f.pid, f.opendap,
+    e.eva_esgf_dataset, a.eva_ensemble_aggregation, f.latest, f.retracted
+    FROM files f
+    JOIN datasets d ON d.dataset = f.dataset
+    JOIN esgf_datasets e ON e.esgf_dataset = d.esgf_dataset
+    JOIN ensemble_aggregations a ON a.ensemble_aggregation = d.ensemble_aggregation""")
+
+
+def publishnormalized(upsert, staged):
+    """Statements moving the staged rows of a query to the normalized layout."""
+    return [
+        """INSERT OR IGNORE INTO esgf_datasets(eva_esgf_dataset)
+        SELECT DISTINCT eva_esgf_dataset FROM staging WHERE rowid IN ({})""".format(staged),
+        """INSERT OR IGNORE INTO ensemble_aggregations(eva_ensemble_aggregation)
+        SELECT DISTINCT eva_ensemble_aggregation FROM staging WHERE rowid IN ({})""".format(staged),
+        """INSERT OR IGNORE INTO datasets(esgf_dataset, ensemble_aggregation, {columns})
+        SELECT e.esgf_dataset, a.ensemble_aggregation, {scolumns} FROM staging s
+        JOIN esgf_datasets e ON e.eva_esgf_dataset = s.eva_esgf_dataset
+        JOIN ensemble_aggregations a ON a.eva_ensemble_aggregation = s.eva_ensemble_aggregation
+        WHERE s.rowid IN ({staged})
+        GROUP BY e.esgf_dataset, a.ensemble_aggregation""".format(
+            columns=",".join(DATASET_COLUMNS),
+            scolumns=",".join(["s." + c for c in DATASET_COLUMNS]),
+            staged=staged),
+        """INSERT {upsert} INTO files({columns}, dataset)
+        SELECT {scolumns}, d.dataset FROM staging s
+        JOIN esgf_datasets e ON e.eva_esgf_dataset = s.eva_esgf_dataset
+        JOIN ensemble_aggregations a ON a.eva_ensemble_aggregation = s.eva_ensemble_aggregation
+        JOIN datasets d ON d.esgf_dataset = e.esgf_dataset AND d.ensemble_aggregation = a.ensemble_aggregation
+        WHERE s.rowid IN ({staged})""".format(
+            upsert="OR REPLACE" if upsert else "",
+            columns=",".join(FILE_COLUMNS),
+            scolumns=",".join(["s." + c for c in FILE_COLUMNS]),
+            staged=staged)]
+
+
+def createkeyindexes(cursor, normalized=False):
+    """Indexes on the aggregation keys, the writer looks up the rows of an aggregation while harvesting."""
+    if normalized:
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS files_dataset ON files(dataset)")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS datasets_esgf_dataset ON datasets(esgf_dataset)")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS datasets_ensemble_aggregation ON datasets(ensemble_aggregation)")
+        return
+
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS cmip6_eva_esgf_dataset ON cmip6(eva_esgf_dataset)")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS cmip6_eva_ensemble_aggregation ON cmip6(eva_ensemble_aggregation)")
+
 
+def createindexes(cursor, normalized=False):
+    createkeyindexes(cursor, normalized)
+    if normalized:
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS datasets_data_node ON datasets(data_node)")
+        return
 
-def search(session, project, query):
-    payload = {
-        "project": "CMIP6",
-        "type": "File",
-        "distrib": "True"
-    }
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS cmip6_data_node ON cmip6(data_node)")
 
-    params = payload.copy()
+
+PAYLOAD = {
+    "project": "CMIP6",
+    "type": "File",
+    "distrib": "True"
+}
+
+
+def search_pages(session, project, query, url=None, inflight=1, paging="offset", skip=()):
+    params = PAYLOAD.copy()
+    params["fields"] = ",".join(project.fields())
     params.update(query)
-    for record in range_search(session, **params):
-        fixed = project.parse_record(record)
-        newrow = (
-            fixed["id"],
-            fixed["version"],
-            fixed["checksum"],
-            fixed["checksum_type"],
-            fixed["data_node"],
-            fixed["index_node"],
-            fixed["instance_id"],
-            fixed["master_id"],
-            str(1 if fixed["replica"] else 0),
-            str(fixed["size"]),
-            fixed["timestamp"],
-            fixed["title"],
-            fixed["tracking_id"],
-            fixed["_timestamp"],
-            fixed["mip_era"],
-            fixed["project"],
-            fixed["institution_id"],
-            fixed["source_id"],
-            fixed["experiment_id"],
-            fixed["table_id"],
-            fixed["variable_id"],
-            fixed["grid_label"],
-            fixed["frequency"],
-            fixed["realm"],
-            fixed["product"],
-            fixed["variant_label"],
-            fixed["member_id"],
-            fixed["sub_experiment_id"],
-            fixed["activity_id"],
-            fixed["further_info_url"],
-            fixed["pid"],
-            fixed["opendap"],
-            fixed["eva_esgf_dataset"],
-            fixed["eva_ensemble_aggregation"]
-        )
-
-        yield newrow
+    if url is None:
+        url = SEARCH
+
+    for key, docs in range_pages(session, url, inflight=inflight, paging=paging, skip=skip, **params):
+        yield key, (project.row(record) for record in docs)
+
+
+def search(session, project, query, url=None, inflight=1, paging="offset"):
+    for _, rows in search_pages(session, project, query, url, inflight, paging):
+        yield from rows
 
 
 class Query:
@@ -304,7 +714,7 @@ class ExtensiveQuery(Query):
         self.to = to
 
     def query(self):
-        for q in project.query():
+        for q in self.project.query():
             qcopy = q.copy()
             if self.frm:
                 qcopy["from"] = self.frm
@@ -340,6 +750,491 @@ class SelectionQuery(Query):
                 yield q
 
 
+def partition(session, url, q, threshold, facets=FACETS):
+    """Split q in sub-queries of at most threshold records.
+
+    numFound and the facet counts of q are requested at once. q is split by
+    the facet giving the most balanced sub-queries, among those whose counts
+    add up to numFound (so no record is lost nor repeated), and sub-queries
+    still too large are split recursively by the remaining facets.
+    """
+    payload = PAYLOAD.copy()
+    payload.update(q)
+    candidates = [f for f in facets if f not in q]
+    payload["facets"] = ",".join(candidates)
+    payload["limit"] = 0
+    payload["format"] = "application/solr+json"
+    r = session.get(url, params=payload, timeout=TIMEOUT)
+    r.raise_for_status()
+    response = r.json()
+
+    n = response["response"]["numFound"]
+    if n <= threshold:
+        return [q]
+
+    best = None
+    for facet in candidates:
+        values = response["facet_counts"]["facet_fields"].get(facet, [])
+        counts = list(zip(values[::2], values[1::2]))
+        if len(counts) < 2 or sum([c for _, c in counts]) != n:
+            continue
+        if best is None or max([c for _, c in counts]) < max([c for _, c in best[1]]):
+            best = (facet, counts)
+
+    if best is None:
+        logging.info("Cannot split {} ({} records).".format(q, n))
+        return [q]
+
+    facet, counts = best
+    logging.info("Split {} ({} records) by {} in {} queries.".format(q, n, facet, len(counts)))
+    queries = []
+    for value, c in counts:
+        sub = dict(q, **{facet: value})
+        if c <= threshold:
+            queries.append(sub)
+        else:
+            queries.extend(partition(session, url, sub, threshold, [f for f in facets if f != facet]))
+
+    return queries
+
+
+class PartitionedQuery(Query):
+    """Queries of another Query, split so none has more than threshold records.
+
+    Sub-queries run, fail and are retried independently, and small queries
+    never need deep offsets.
+    """
+
+    def __init__(self, query, nodes, threshold, facets=FACETS):
+        self.inner = query
+        self.nodes = nodes
+        self.threshold = threshold
+        self.facets = facets
+
+    def query(self):
+        for q in self.inner.query():
+            index = self.nodes.acquire()
+            try:
+                queries = partition(self.nodes.session(index), search_url(index), q, self.threshold, self.facets)
+            except:
+                logging.exception("Failed while splitting {}.".format(q))
+                queries = [q]
+            finally:
+                self.nodes.release(index)
+
+            for sub in queries:
+                yield sub
+
+
+class IndexNode():
+    """Health of an index node as seen by the harvest.
+
+    Latency and error rate are exponentially weighted moving averages. After
+    TRIP consecutive failures the circuit opens and the node gets no queries
+    for a backoff period. Then it is half-open: a single query probes it,
+    closing the circuit if it succeeds or opening it again for twice as long.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.latency = None
+        self.errors = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.consecutive = 0
+        self.inflight = 0
+        self.state = "closed"
+        self.backoff = BACKOFF
+        self.until = 0
+
+    def available(self, now):
+        if self.state == "open" and now >= self.until:
+            self.state = "half-open"
+            logging.info("Probing INDEX: {}.".format(self.name))
+        return self.state == "closed" or (self.state == "half-open" and self.inflight == 0)
+
+    def score(self):
+        # unknown nodes are tried first, busy or failing nodes are penalized
+        latency = self.latency if self.latency is not None else 0
+        return latency * (1 + self.inflight) / max(1 - self.errors, 0.1)
+
+    def report(self, latency, ok, timeout=False):
+        self.requests += 1
+        self.errors = (1 - EWMA) * self.errors + EWMA * (0 if ok else 1)
+        if ok:
+            self.latency = latency if self.latency is None else (1 - EWMA) * self.latency + EWMA * latency
+            self.consecutive = 0
+            if self.state == "half-open":
+                logging.info("Closing circuit of INDEX: {}.".format(self.name))
+                self.state = "closed"
+                self.backoff = BACKOFF
+            return
+
+        self.failures += 1
+        self.timeouts += 1 if timeout else 0
+        self.consecutive += 1
+        if self.state == "half-open" or (self.state == "closed" and self.consecutive >= TRIP):
+            if self.state == "half-open":
+                self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+            self.state = "open"
+            self.until = time.monotonic() + self.backoff
+            logging.info("Opening circuit of INDEX: {} for {} s.".format(self.name, self.backoff))
+
+    def __str__(self):
+        return "{}: {} requests, {} failures, {} timeouts, {} latency, circuit {}".format(
+            self.name, self.requests, self.failures, self.timeouts,
+            "{:.2f} s".format(self.latency) if self.latency is not None else "unknown",
+            self.state)
+
+
+class NodeSession():
+    """requests.Session of an index node that reports every request to the scheduler."""
+
+    def __init__(self, scheduler, node, session):
+        self.scheduler = scheduler
+        self.node = node
+        self.session = session
+
+    def get(self, url, **kwargs):
+        start = time.monotonic()
+        with metrics.stage("search_request", index_node=self.node):
+            try:
+                r = self.session.get(url, **kwargs)
+            except requests.Timeout:
+                self.scheduler.report(self.node, time.monotonic() - start, False, True)
+                metrics.METRICS.inc("search_errors_total", index_node=self.node, error="timeout")
+                raise
+            except requests.RequestException:
+                self.scheduler.report(self.node, time.monotonic() - start, False)
+                metrics.METRICS.inc("search_errors_total", index_node=self.node, error="connection")
+                raise
+
+        self.scheduler.report(self.node, time.monotonic() - start, r.status_code < 500)
+        if r.status_code >= 400:
+            metrics.METRICS.inc("search_errors_total", index_node=self.node, error=r.status_code)
+        r.node = self.node  # streamed responses count their bytes once read, see iter_docs
+        if not kwargs.get("stream"):
+            metrics.METRICS.inc("search_response_bytes_total", r.raw.tell(), index_node=self.node)
+        return r
+
+    def close(self):
+        self.session.close()
+
+
+class Scheduler():
+    """Index nodes shared by the harvest workers.
+
+    Each query is sent to the healthiest available index node, taking into
+    account its latency, error rate and the queries it is already serving,
+    so work is spread across all healthy index nodes. Nodes failing
+    repeatedly are left alone for a while (see IndexNode).
+
+    Each index node gets a single keep-alive session whose connection pool
+    is sized to the number of workers, so concurrent queries against the
+    same node reuse connections instead of opening new ones.
+    """
+
+    def __init__(self, nodes, jobs=1):
+        self.nodes = {}
+        self.sessions = {}
+        self.lock = threading.Lock()
+        for node in nodes:
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=jobs))
+            session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=jobs))
+            self.nodes[node] = IndexNode(node)
+            self.sessions[node] = NodeSession(self, node, session)
+
+    def acquire(self, prefer=None, avoid=None):
+        """Index node for the next query, waits while every circuit is open.
+
+        The preferred node is used if available; the node to avoid is only
+        used if no other node is available.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                available = [n for n in self.nodes.values() if n.available(now)]
+                if prefer in self.nodes and self.nodes[prefer] in available:
+                    node = self.nodes[prefer]
+                elif available:
+                    others = [n for n in available if n.name != avoid] or available
+                    node = min(others, key=lambda n: (n.score(), n.inflight))
+                else:
+                    node = None
+                    wake = min([n.until for n in self.nodes.values()])
+
+                if node is not None:
+                    node.inflight += 1
+                    return node.name
+
+            time.sleep(max(wake - now, 0.1))
+
+    def release(self, node):
+        with self.lock:
+            self.nodes[node].inflight -= 1
+
+    def report(self, node, latency, ok, timeout=False):
+        with self.lock:
+            self.nodes[node].report(latency, ok, timeout)
+
+    def session(self, node):
+        return self.sessions[node]
+
+    def get(self, params):
+        """JSON response of a request without pages (eg: facets), retried on other index nodes like a query."""
+        tolerance = 0
+        failed = None
+        while True:
+            index = self.acquire(avoid=failed)
+            try:
+                r = self.session(index).get(search_url(index), params=params, timeout=TIMEOUT)
+                r.raise_for_status()
+                return r.json()
+            except:
+                logging.exception("Failed while requesting {} from {}.".format(params, index))
+
+                # too many errors?
+                tolerance += 1
+                if tolerance >= TOLERANCE:
+                    raise
+
+                failed = index
+            finally:
+                self.release(index)
+
+    def close(self):
+        for node in self.nodes.values():
+            logging.info(str(node))
+        for session in self.sessions.values():
+            session.close()
+
+
+def query_key(q):
+    # from/to change between runs, they are not part of the query identity
+    return json.dumps({k: v for k, v in q.items() if k not in ("from", "to")}, sort_keys=True)
+
+
+def get_mark(conn, key):
+    mark = conn.execute("SELECT mark FROM harvest WHERE query = ?", (key,)).fetchone()
+    return mark[0] if mark else None
+
+
+class Writer(threading.Thread):
+    """Single thread storing the rows retrieved by the harvest workers.
+
+    Workers send batches of rows of a query through a bounded queue and keep
+    fetching while the batches are written. Rows are staged in the staging
+    table and each complete page is checkpointed in the pages table, so an
+    interrupted query continues from its last good page. Staged rows are
+    moved to cmip6 in one transaction when the query is committed, so each
+    query is still all-or-nothing.
+    """
+
+    def __init__(self, dest, upsert=False, normalized=False):
+        super().__init__(daemon=True)
+        self.dest = dest
+        self.upsert = upsert
+        self.normalized = normalized
+        self.queue = queue.Queue(QUEUE)
+        self.error = None
+        self.rows = 0
+        self.started = None
+
+    def run(self):
+        conn = sqlite3.connect(self.dest, isolation_level=None)
+        try:
+            conn.execute("PRAGMA synchronous=NORMAL")  # safe with WAL, only fsync on checkpoints
+            conn.execute("PRAGMA cache_size=-262144")  # 256 MiB
+            columns = ",".join([c[1] for c in conn.execute("PRAGMA table_info(cmip6)")])
+            # the query, then the columns of cmip6
+            staging = [c[1] for c in conn.execute("PRAGMA table_info(staging)")]
+            stage = "INSERT INTO staging VALUES({})".format(",".join(["?" for _ in staging]))
+
+            # a page may have been staged twice if the process died before its checkpoint
+            staged = "SELECT max(rowid) FROM staging WHERE query = :query GROUP BY id"
+            if self.normalized:
+                publish = publishnormalized(self.upsert, staged)
+            else:
+                publish = ["INSERT {} INTO cmip6({}) SELECT {} FROM staging WHERE rowid IN ({})".format(
+                    "OR REPLACE" if self.upsert else "", columns, columns, staged)]
+            stats = """SELECT count(*), max(_timestamp), sum(latest = 0), sum(retracted = 1)
+            FROM staging WHERE rowid IN ({})""".format(staged)
+            # status of the aggregations of the staged rows, from all their rows once published: other queries and
+            # previous runs may have stored other members
+            versions = ["""SELECT '{0}', {0}, data_node, min(retracted) FROM cmip6
+            WHERE {0} IN (SELECT {0} FROM staging WHERE rowid IN ({1})) GROUP BY 2, 3""".format(kind, staged)
+                        for kind in VERSIONED]
+
+            while True:
+                kind, key, payload, done = self.queue.get()
+                if kind == "stop":
+                    break
+
+                if not conn.in_transaction:
+                    conn.execute("begin")
+
+                with metrics.stage("search_write", kind=kind):
+                    if kind == "rows":
+                        conn.executemany(stage, [(key,) + row for row in payload])
+                        metrics.METRICS.inc("search_staged_rows_total", len(payload))
+                    elif kind == "page":
+                        page, node, n = payload
+                        conn.execute("INSERT OR REPLACE INTO pages VALUES(?, ?, ?, ?)", (key, page, node, n))
+                        conn.execute("commit")
+                    elif kind == "commit":
+                        n, mark, superseded, retracted = conn.execute(stats, {"query": key}).fetchone()
+                        for statement in publish:
+                            conn.execute(statement, {"query": key})
+                        update_versions(conn, [row for v in versions for row in conn.execute(v, {"query": key})])
+                        conn.execute("DELETE FROM staging WHERE query = ?", (key,))
+                        conn.execute("DELETE FROM pages WHERE query = ?", (key,))
+
+                        # _timestamp of the newest record is the high-water mark
+                        mark = max([mark or "", get_mark(conn, key) or ""]) or None
+                        conn.execute(
+                            "INSERT OR REPLACE INTO harvest VALUES(?, ?, ?, 1)",
+                            (key, mark, format_timestamp(datetime.datetime.now(datetime.timezone.utc))))
+                        conn.execute("commit")
+
+                if kind == "commit":
+                    self.rows += n
+                    metrics.METRICS.inc("search_rows_total", n)
+                    logging.info("{}: {} rows stored, {} not latest, {} retracted ({:.0f} rows/s).".format(
+                        key, n, superseded, retracted, self.rate()))
+
+                done.set()
+
+            if conn.in_transaction:
+                conn.execute("commit")
+        except Exception as e:
+            logging.exception("Writer failed.")
+            self.error = e
+            if conn.in_transaction:
+                conn.execute("rollback")
+        finally:
+            conn.close()
+
+    def rate(self):
+        if self.started is None:
+            return 0
+        return self.rows / max(time.monotonic() - self.started, 1e-9)
+
+    def put(self, kind, key=None, payload=None):
+        if self.started is None:
+            self.started = time.monotonic()
+
+        done = threading.Event()
+        while True:
+            if self.error is not None:
+                raise RuntimeError("Writer failed.") from self.error
+            try:
+                self.queue.put((kind, key, payload, done), timeout=1)
+                return done
+            except queue.Full:
+                pass
+
+    def send(self, key, rows):
+        self.put("rows", key, rows)
+
+    def checkpoint(self, key, page, node, n):
+        self.put("page", key, (page, node, n))
+
+    def commit(self, key):
+        done = self.put("commit", key)
+        while not done.wait(1):
+            if self.error is not None:
+                raise RuntimeError("Writer failed.") from self.error
+
+    def close(self):
+        if self.error is None:
+            self.put("stop")
+        self.join()
+
+
+def checkpoints(conn, key):
+    """Pages of the query already staged and the index node that served them."""
+    pages = conn.execute("SELECT page, node FROM pages WHERE query = ? ORDER BY rowid", (key,)).fetchall()
+    return set([page for page, _ in pages]), pages[-1][1] if pages else None
+
+
+def finished(conn, key):
+    return conn.execute("SELECT done FROM harvest WHERE query = ?", (key,)).fetchone() in ((1,),)
+
+
+def delta(conn, lock, q):
+    """Restrict q to the records published after its high-water mark."""
+    with lock:
+        mark = get_mark(conn, query_key(q))
+
+    if mark is None:
+        return q, None
+
+    q = q.copy()
+    if "from" not in q or parse_timestamp(q["from"]) < parse_timestamp(mark):
+        q["from"] = mark
+
+    return q, mark
+
+
+def harvest(writer, conn, lock, nodes, project, q, inflight=1, paging="offset", incremental=False):
+    """Retrieve all records for q and send them to the writer as a single transaction.
+
+    In incremental mode only the records newer than the high-water mark of
+    the query are requested and upserted by id. Records retracted since the
+    mark are requested too, so their status is updated in the database.
+
+    Pages already checkpointed, by a previous attempt or a previous run, are
+    not requested again. Index nodes are chosen by the scheduler, and the
+    query raises after TOLERANCE failures.
+    """
+    key = query_key(q)
+    mark = None
+    if incremental:
+        q, mark = delta(conn, lock, q)
+
+    queries = [q]
+    if mark is not None:
+        queries.append(dict(q, retracted="true"))
+
+    # offset pages are only valid on the index node that served them
+    with lock:
+        done, prefer = checkpoints(conn, key)
+
+    tolerance = 0
+    failed = None
+    while True:
+        index = nodes.acquire(prefer, failed)
+        try:
+            session = nodes.session(index)
+            for sq in queries:
+                pages = search_pages(session, project, sq, search_url(index), inflight, paging, done)
+                for page, rows in pages:
+                    n = 0
+                    with metrics.stage("search_page", index_node=index):
+                        for batch in iter(lambda: list(itertools.islice(rows, BATCH)), []):
+                            writer.send(key, batch)
+                            n += len(batch)
+                    writer.checkpoint(key, page, index, n)
+                    done.add(page)
+            writer.commit(key)
+            return
+        except:
+            logging.exception(
+                "Failed while retrieving {}.".format(q))
+
+            # too many errors?
+            tolerance += 1
+            if tolerance >= TOLERANCE or writer.error is not None:
+                raise
+
+            # use the healthiest index node, avoiding the one that just failed
+            failed, prefer = index, None
+        finally:
+            nodes.release(index)
+
+
 if __name__ == "__main__":
     # arguments
     parser = argparse.ArgumentParser(description="Query ESGF files and store results in sqlite.")
@@ -374,70 +1269,149 @@ if __name__ == "__main__":
                         required=False,
                         default=None,
                         help="ESGF search 'from' keyword.")
+    parser.add_argument("-j", "--jobs",
+                        type=int,
+                        required=False,
+                        default=1,
+                        help="number of queries harvested concurrently.")
+    parser.add_argument("--pages",
+                        type=int,
+                        required=False,
+                        default=1,
+                        help="number of pages of a query requested concurrently.")
+    parser.add_argument("--paging",
+                        choices=["offset", "timestamp"],
+                        default="offset",
+                        type=str,
+                        required=False,
+                        help="walk results by offset or by _timestamp windows (no deep offsets).")
+    parser.add_argument("--split",
+                        type=int,
+                        required=False,
+                        default=None,
+                        help="split queries with more records than this by facet (data_node, table_id, ...).")
+    parser.add_argument("--index-node",
+                        nargs="+",
+                        type=str,
+                        required=False,
+                        default=INDEX_NODES,
+                        help="index nodes, host names or URLs like http://localhost:8080.")
+    parser.add_argument("-n", "--normalized",
+                        action="store_true",
+                        default=False,
+                        help="store dataset facets once and files by dataset key, cmip6 becomes a view.")
+    parser.add_argument("--limit",
+                        type=int,
+                        required=False,
+                        default=LIMIT,
+                        help="records per page.")
+    parser.add_argument("-i", "--incremental",
+                        action="store_true",
+                        default=False,
+                        help="keep the database, only harvest records newer than the last run.")
+    parser.add_argument("-r", "--resume",
+                        action="store_true",
+                        default=False,
+                        help="resume an interrupted harvest, finished queries are not requested again.")
+    parser.add_argument("--metrics",
+                        type=str,
+                        required=False,
+                        default=None,
+                        help="write metrics to this file periodically, in the Prometheus text format if it ends in .prom, "
+                             "JSON otherwise.")
+    parser.add_argument("--metrics-interval",
+                        type=float,
+                        required=False,
+                        default=metrics.INTERVAL,
+                        help="seconds between metrics snapshots.")
+    parser.add_argument("--profile",
+                        type=str,
+                        required=False,
+                        default=None,
+                        choices=["search_request", "search_page", "search_write"],
+                        help="profile this stage with cProfile, written to <stage>.<pid>.prof.")
     parser.set_defaults()
     args = vars(parser.parse_args())
 
     logging.basicConfig(filename=args["log_file"],
                         level=logging.DEBUG)
+    LIMIT = args["limit"]
+    INDEX_NODES = args["index_node"]
+    INDEX = INDEX_NODES[0]
+    SEARCH = search_url(INDEX)
+
+    # start searching
+    logging.info("Create Sessions: {}".format(INDEX_NODES))
+    nodes = Scheduler(INDEX_NODES, args["jobs"] * args["pages"])
 
     if args["project"] == "CMIP6":
-        project = Cmip6()
+        project = Cmip6(nodes)
 
     if args["selection"]:
         query = SelectionQuery(args["selection"])
     else:
         query = ExtensiveQuery(project, args["from"], args["to"])
 
+    if args["split"]:
+        query = PartitionedQuery(query, nodes, args["split"])
+
     # create sqlite db and get connection
     logging.info("Set up sqlite database.")
-    conn = sqlite3.connect(args["dest"])
+    conn = sqlite3.connect(args["dest"], check_same_thread=False)
     c = conn.cursor()
-    createdb(c)
+    normalized, unique = createdb(c, args["incremental"], args["resume"], args["normalized"])
+    c.execute("PRAGMA journal_mode=WAL").fetchone()
+    lock = threading.Lock()
 
-    # start searching
-    logging.info("Create Session: {}".format(INDEX))
-    s = requests.Session()
+    # rows are stored by a single writer while workers keep fetching
+    writer = Writer(args["dest"], unique, normalized)
+    writer.start()
+
+    metrics.configure(args["profile"])
+    exporter = None
+    if args["metrics"]:
+        def gauges():
+            metrics.METRICS.set("search_rows_per_second", writer.rate())
+            metrics.METRICS.set("search_writer_queue", writer.queue.qsize())
+
+        exporter = metrics.Exporter(args["metrics"], args["metrics_interval"], gauges=gauges)
+        exporter.start()
 
     try:
-        i = 0
-        for q in query.query():
-            inserted = False
-            tolerance = 0
-            while not inserted:  # loop index nodes while failing
-                try:
-                    conn.execute("begin")
-                    for row in search(s, project, q):
-                        c.execute(
-                            "INSERT INTO cmip6 VALUES({})".format(
-                                ",".join(["?" for _ in range(len(row))])),
-                            row)
-                    conn.commit()
-                    inserted = True
-                except:
-                    conn.execute("rollback")
-                    logging.exception(
-                        "Failed while retrieving {}.".format(q))
-                    s.close()
-
-                    # too many errors?
-                    tolerance += 1
-                    if tolerance >= TOLERANCE:
-                        sys.exit(2)
-
-                    # use new index
-                    i = (i + 1) % len(INDEX_NODES)
-                    INDEX = INDEX_NODES[i]
-                    SEARCH = "https://{}/esg-search/search".format(INDEX)
-                    s = requests.Session()
-                    logging.info("Changing INDEX to: {}.".format(INDEX))
-        s.close()
+        with ThreadPoolExecutor(args["jobs"]) as executor:
+            pending = set()
+            try:
+                for q in query.query():
+                    if args["resume"]:
+                        with lock:
+                            if finished(conn, query_key(q)):
+                                continue
+
+                    # keep the number of queued queries bounded
+                    if len(pending) >= args["jobs"]:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    pending.add(executor.submit(
+                        harvest, writer, conn, lock, nodes, project, q, args["pages"], args["paging"], args["incremental"]))
+
+                for future in wait(pending).done:
+                    future.result()
+            except:
+                logging.exception("Harvest aborted.")
+                executor.shutdown(wait=True, cancel_futures=True)
+                sys.exit(2)
     finally:
-        c.execute(
-            "CREATE INDEX cmip6_data_node ON cmip6(data_node)")
-        c.execute(
-            "CREATE INDEX cmip6_eva_esgf_dataset ON cmip6(eva_esgf_dataset)")
-        c.execute(
-            "CREATE INDEX cmip6_eva_ensemble_aggregation ON cmip6(eva_ensemble_aggregation)")
+        nodes.close()
+        writer.close()
+        print("Stored {} rows ({:.0f} rows/s).".format(writer.rows, writer.rate()), flush=True)
+        logging.info("Stored {} rows ({:.0f} rows/s).".format(writer.rows, writer.rate()))
+        if exporter is not None:
+            exporter.close()
+        metrics.dump_profile()
+
+        # other indexes are built once, after the bulk load
+        createindexes(c, normalized)
 
         c.close()
         conn.close()